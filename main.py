@@ -1,13 +1,221 @@
 import os
+import sys
+
+
+# --- Shell completion fast path ---------------------------------------------
+# Every TAB runs the program once. Env keys, template names and wm projects
+# are answered here from a small cache file *before* click and the rest of
+# the stdlib are imported, so this section only uses os/sys. The cache is
+# rewritten by regular commands (refresh_completion_cache); completion
+# itself never writes and never opens the history DB. Anything else falls
+# through to click's own completion.
+
+COMPLETION_CACHE_VERSION = 'tos-completion-v1'
+
+
+def _completion_config_dir():
+    """get_config_dir() without pathlib/platform (keeps TAB cheap)."""
+    tos_home = os.getenv('TOS_HOME')
+    if tos_home:
+        return tos_home
+    if os.name == 'nt' and os.getenv('LOCALAPPDATA'):
+        return os.path.join(os.getenv('LOCALAPPDATA'), 'tos')
+    return os.path.join(os.path.expanduser('~'), '.tos')
+
+
+def _completion_stamp(path):
+    """Return 'mtime_ns:size' for path, or '-' if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return '-'
+    return f'{st.st_mtime_ns}:{st.st_size}'
+
+
+def _list_subdirs(path):
+    """Names of non-hidden subdirectories of path."""
+    try:
+        with os.scandir(path) as it:
+            return sorted(e.name for e in it if not e.name.startswith('.') and e.is_dir())
+    except OSError:
+        return []
+
+
+def _build_completion_data(config_dir):
+    """Collect completion candidates from the env CSV and directories."""
+    import csv
+
+    env_file = os.path.join(config_dir, 'tos_env.csv')
+    templates_dir = os.path.join(config_dir, 'templates')
+    env_vars = {}
+    try:
+        with open(env_file, 'r', newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                env_vars[row['key']] = row['value']
+    except (OSError, KeyError):
+        pass
+
+    wm_dir = ''
+    for k, v in env_vars.items():
+        if k.lower() == 'wm':
+            wm_dir = v
+            break
+
+    return {
+        'stamps': {
+            'env': (env_file, _completion_stamp(env_file)),
+            'templates': (templates_dir, _completion_stamp(templates_dir)),
+            'wm': (wm_dir, _completion_stamp(wm_dir) if wm_dir else '-'),
+        },
+        'env': sorted(env_vars, key=str.lower),
+        'templates': _list_subdirs(templates_dir),
+        'projects': _list_subdirs(wm_dir) if wm_dir else [],
+    }
+
+
+def _read_completion_cache(cache_file):
+    """Parse the tab-separated completion cache, or return None."""
+    kinds = {'E': 'env', 'T': 'templates', 'P': 'projects'}
+    data = {'stamps': {}, 'env': [], 'templates': [], 'projects': []}
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            if f.readline().rstrip('\n') != COMPLETION_CACHE_VERSION:
+                return None
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if parts[0] == 'S' and len(parts) == 4:
+                    data['stamps'][parts[1]] = (parts[2], parts[3])
+                elif parts[0] in kinds and len(parts) == 2:
+                    data[kinds[parts[0]]].append(parts[1])
+    except OSError:
+        return None
+    return data
+
+
+def _completion_data_is_fresh(data):
+    """True if every source recorded in the cache is unchanged."""
+    stamps = data['stamps']
+    if set(stamps) != {'env', 'templates', 'wm'}:
+        return False
+    return all(
+        (not path and stamp == '-') or _completion_stamp(path) == stamp
+        for path, stamp in stamps.values()
+    )
+
+
+def load_completion_data():
+    """Return (data, fresh) for completion, reading the cache if it is valid.
+
+    A stale or missing cache is recomputed in memory; nothing is written.
+    """
+    config_dir = _completion_config_dir()
+    data = _read_completion_cache(os.path.join(config_dir, 'completion_cache.tsv'))
+    if data is not None and _completion_data_is_fresh(data):
+        return data, True
+    return _build_completion_data(config_dir), False
+
+
+def _completion_matches(candidates, incomplete):
+    """Case-insensitive prefix filter (env keys resolve case-insensitively)."""
+    prefix = incomplete.lower()
+    return [c for c in candidates if c.lower().startswith(prefix)]
+
+
+def _completion_candidates(args, incomplete, data):
+    """Candidates for the cached parameters, or None if not handled here.
+
+    Covers `cd`, `path`, `env like`, `init -t`, `wm -t` and `wm <project>`.
+    """
+    if not args or incomplete.startswith('-'):
+        return None
+    command = args[0]
+    if command in ('init', 'wm') and args[-1] in ('-t', '--template'):
+        return _completion_matches(data['templates'], incomplete)
+    if command in ('cd', 'path') and len(args) == 1:
+        return _completion_matches(data['env'], incomplete)
+    if command == 'env' and len(args) >= 2 and args[1] == 'like':
+        return _completion_matches(data['env'], incomplete)
+    if command == 'wm':
+        value_options = ('-t', '--template', '-r', '--recent', '--sort', '--filter')
+        if args[-1] in value_options:
+            return None  # an option value; click completes --sort choices
+        skip_next = False
+        for arg in args[1:]:
+            if skip_next:
+                skip_next = False
+            elif arg in value_options:
+                skip_next = True
+            elif not arg.startswith('-'):
+                return None  # project already given
+        return _completion_matches(data['projects'], incomplete)
+    return None
+
+
+def _fast_complete():
+    """Answer a click completion request from the cache, if possible.
+
+    Returns without output when the request isn't one we handle (or the
+    words contain quoting), so click's completion takes over.
+    """
+    instruction = os.environ.get('_TOS_COMPLETE') or os.environ.get('_T_COMPLETE') or ''
+    shell, _, mode = instruction.partition('_')
+    if mode != 'complete' or shell not in ('bash', 'zsh', 'fish', 'powershell'):
+        return
+
+    comp_words = os.environ.get('COMP_WORDS', '')
+    comp_cword = os.environ.get('COMP_CWORD', '')
+    if any(q in comp_words + comp_cword for q in '"\'\\'):
+        return
+    words = comp_words.split()
+
+    if shell == 'fish':
+        incomplete = comp_cword
+        args = words[1:]
+        if incomplete and args and args[-1] == incomplete:
+            args.pop()
+    else:
+        try:
+            cword = int(comp_cword)
+        except ValueError:
+            return
+        args = words[1:cword]
+        incomplete = words[cword] if cword < len(words) else ''
+
+    data, _ = load_completion_data()
+    candidates = _completion_candidates(args, incomplete, data)
+    if candidates is None:
+        return
+
+    if shell in ('zsh', 'powershell'):
+        out = [f'plain\n{c}\n_' for c in candidates]
+    else:
+        out = [f'plain,{c}' for c in candidates]
+    sys.stdout.write('\n'.join(out))
+    sys.stdout.flush()
+    sys.exit(0)
+
+
+if '_TOS_COMPLETE' in os.environ or '_T_COMPLETE' in os.environ:
+    _fast_complete()
+
+
 import shutil
 import csv
 import platform
 import sqlite3
-import sys
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from pathlib import Path
 from datetime import datetime
 import click
 import fnmatch
+import json
+import re
+import shlex
 
 
 def get_config_dir():
@@ -59,6 +267,7 @@ def get_db_file():
 def init_db():
     """Initialize the SQLite database for command history."""
     db_file = get_db_file()
+    db_file.parent.mkdir(parents=True, exist_ok=True)
     
     conn = sqlite3.connect(db_file)
     cursor = conn.cursor()
@@ -86,12 +295,72 @@ def init_db():
         ON command_history(command)
     ''')
     
+    # machine_id was added for `tos history merge`; rows logged before
+    # that came from this machine
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(command_history)")]
+    if 'machine_id' not in columns:
+        cursor.execute("ALTER TABLE command_history ADD COLUMN machine_id TEXT")
+        cursor.execute("UPDATE command_history SET machine_id = ?", (get_machine_id(),))
+    
+    # Natural key used to deduplicate merged history
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_natural_key
+        ON command_history(timestamp, command, arguments, working_directory, machine_id)
+    ''')
+    
+    # Per-source high-water marks for `tos history merge`
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS history_merge_state (
+            source TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            merged_on DATETIME
+        )
+    ''')
+    
     conn.commit()
     conn.close()
 
 
+_machine_id = None
+
+
+def get_machine_id():
+    """Identify this workstation in history rows.
+
+    `machine_id` under [settings] in tos_config.toml, else the host name.
+    """
+    global _machine_id
+    if _machine_id is None:
+        config = load_config_toml()
+        _machine_id = str(config.get('settings', {}).get('machine_id')
+                          or config.get('machine_id') or platform.node() or 'unknown')
+    return _machine_id
+
+
+# Shared state while `tos batch` / `tos shell` runs commands in-process:
+# one DB connection, pending history rows, the current line's argv and a
+# cached env map. None when running a single command.
+_session = None
+
+# Row id of this process's own history entry (single-command mode)
+_logged_command_id = None
+
+
 def log_command(command, arguments=None, status='success'):
     """Log a command execution to the database."""
+    entry = (
+        datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        command,
+        arguments or '',
+        str(Path.cwd()),
+        status
+    )
+
+    # Batch/shell mode: queue the row, it is written with the session
+    if _session is not None:
+        _session['history'].append(entry)
+        return
+
     try:
         init_db()  # Ensure DB exists
         db_file = get_db_file()
@@ -100,23 +369,75 @@ def log_command(command, arguments=None, status='success'):
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT INTO command_history (timestamp, command, arguments, working_directory, status)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
-            datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            command,
-            arguments or '',
-            str(Path.cwd()),
-            status
-        ))
+            INSERT INTO command_history (timestamp, command, arguments, working_directory, status, machine_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', entry + (get_machine_id(),))
         
         conn.commit()
         conn.close()
+        global _logged_command_id
+        _logged_command_id = cursor.lastrowid
     except Exception as e:
         # Don't fail if logging fails
         pass
 
 
+def mark_command_failed():
+    """Set this process's own history entry to status 'error'."""
+    if _logged_command_id is None:
+        return
+    try:
+        conn = sqlite3.connect(get_db_file())
+        with conn:
+            conn.execute("UPDATE command_history SET status = 'error' WHERE id = ?",
+                         (_logged_command_id,))
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+@contextmanager
+def history_connection():
+    """Connection for reading history.
+
+    In batch/shell mode this is the session's shared connection, with
+    queued rows flushed first so earlier lines are visible.
+    """
+    if _session is not None:
+        _flush_session_history()
+        yield _session['conn']
+        return
+    conn = sqlite3.connect(get_db_file())
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def echo_error(message):
+    """Print an error to stderr.
+
+    Commands report failures this way and return normally; in batch/shell
+    mode this also marks the current line as failed.
+    """
+    click.echo(message, err=True)
+    if _session is not None:
+        _session['error'] = message
+
+
+def _shell_split(line):
+    """Split a command line into words.
+
+    Quotes group words as in a shell, but backslashes are kept literally
+    so Windows paths survive.
+    """
+    lexer = shlex.shlex(line, posix=True)
+    lexer.whitespace_split = True
+    lexer.escape = ''
+    lexer.commenters = ''
+    return list(lexer)
+
+
 def load_config_toml():
     """Load the TOS configuration from TOML file."""
     config_file = get_config_toml_file()
@@ -138,63 +459,272 @@ def load_config_toml():
         return default_config
 
 
+LOCK_TIMEOUT = 10.0
+
+# The umask can only be read by setting it, and it is process-wide, so
+# read it once here before any worker threads exist
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+ENV_FIELDS = ['key', 'value', 'updated_on', 'comment']
+
+
+@contextmanager
+def file_lock(path, timeout=LOCK_TIMEOUT):
+    """Hold an exclusive advisory lock on `<path>.lock`.
+
+    Uses fcntl on POSIX and msvcrt on Windows. Raises TimeoutError if the
+    lock can't be acquired within `timeout` seconds.
+    """
+    lock_path = Path(str(path) + '.lock')
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    f = open(lock_path, 'a+')
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                if os.name == 'nt':
+                    import msvcrt
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    import fcntl
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Timed out waiting for lock: {lock_path}")
+                time.sleep(0.01)
+        yield
+    finally:
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        except OSError:
+            pass
+        f.close()
+
+
+@contextmanager
+def atomic_write(path, mode='w', **open_kwargs):
+    """Write to a temp file next to `path`, then os.replace() it into place.
+
+    Readers never see a partially written file. On error the temp file is
+    removed and `path` is left untouched.
+    """
+    path = Path(path)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        # mkstemp creates 0600 files; keep the permissions a plain open() would give
+        if path.exists():
+            shutil.copymode(path, tmp_name)
+        else:
+            os.chmod(tmp_name, 0o666 & ~_UMASK)
+        with open(fd, mode, **open_kwargs) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
+def _write_env_rows(env_file, rows):
+    """Atomically rewrite tos_env.csv with the given rows."""
+    with atomic_write(env_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=ENV_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
 def ensure_config_exists():
     """Ensure config directory and default configuration files exist."""
     config_dir = get_config_dir()
     env_file = get_env_file()
     config_toml = get_config_toml_file()
-    
+    templates_dir = config_dir / 'templates'
+
+    # Fast path: nothing to create, no lock needed
+    if env_file.exists() and config_toml.exists() and templates_dir.is_dir():
+        return config_dir, env_file
+
     # Create config directory if it doesn't exist
     config_dir.mkdir(parents=True, exist_ok=True)
-    
+
     # Create templates directory
-    templates_dir = config_dir / 'templates'
     templates_dir.mkdir(exist_ok=True)
-    
-    # Create default config TOML if it doesn't exist
-    if not config_toml.exists():
-        default_toml = '''# TOS Configuration File
+
+    # Another process may be creating the same files on first run
+    with file_lock(config_dir / '.config'):
+        # Create default config TOML if it doesn't exist
+        if not config_toml.exists():
+            default_toml = '''# TOS Configuration File
 
 [settings]
 # Maximum number of history entries to display per page
 history_limit = 100
+# Editor used by `tos wm` (code, cursor, vim, or a full command line)
+editor = "code"
 '''
-        with open(config_toml, 'w', encoding='utf-8') as f:
-            f.write(default_toml)
-    
-    # Create default environment CSV file if it doesn't exist
-    if not env_file.exists():
-        with open(env_file, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=['key', 'value', 'updated_on', 'comment'])
-            writer.writeheader()
+            with atomic_write(config_toml, 'w', encoding='utf-8') as f:
+                f.write(default_toml)
+
+        # Create default environment CSV file if it doesn't exist
+        if not env_file.exists():
+            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             # Add default entries
-            writer.writerow({
-                'key': 'tools',
-                'value': 'c:\\aka\\tools',
-                'updated_on': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'comment': 'Development tools'
-            })
-            writer.writerow({
-                'key': 'proj_a_code',
-                'value': 'd:\\aka\\projects\\project_a\\code',
-                'updated_on': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'comment': 'Project A code directory'
-            })
-    
+            _write_env_rows(env_file, [
+                {
+                    'key': 'tools',
+                    'value': 'c:\\aka\\tools',
+                    'updated_on': timestamp,
+                    'comment': 'Development tools'
+                },
+                {
+                    'key': 'proj_a_code',
+                    'value': 'd:\\aka\\projects\\project_a\\code',
+                    'updated_on': timestamp,
+                    'comment': 'Project A code directory'
+                },
+            ])
+
     return config_dir, env_file
 
 
-def load_env_config():
-    """Load the TOS environment configuration from CSV file."""
-    ensure_config_exists()
-    env_file = get_env_file()
-    
+ENV_LAYER_CACHE_SIZE = 64
+# Bump when the merge rules change so cached maps are rebuilt
+ENV_LAYER_CACHE_VERSION = 2
+
+# In-memory copy of env_layers_cache.json, loaded on first use. sync
+# workers can resolve env maps concurrently, so all access holds the lock.
+_env_layer_cache = None
+_env_layer_lock = threading.Lock()
+
+
+def get_env_layers_cache_file():
+    """Get the per-directory env resolution cache path."""
+    return get_config_dir() / 'env_layers_cache.json'
+
+
+def find_env_layers(start=None):
+    """Return (env files that apply in start, probed paths).
+
+    Files are in precedence order, lowest first: the global tos_env.csv,
+    then every .tos/tos_env.csv from the outermost project down to the
+    nearest. The probed paths (each ancestor and its .tos dir) are the
+    ones whose mtimes change when a project env file appears or goes away.
+    """
+    config_dir = os.path.realpath(get_config_dir())
+    current = os.path.abspath(start or os.getcwd())
+    project_files = []
+    probes = []
+    while True:
+        probes.append(current)
+        tos_dir = os.path.join(current, '.tos')
+        if os.path.isdir(tos_dir) and os.path.realpath(tos_dir) != config_dir:
+            probes.append(tos_dir)
+            env_file = os.path.join(tos_dir, 'tos_env.csv')
+            if os.path.isfile(env_file):
+                project_files.append(env_file)
+        parent = os.path.dirname(current)
+        if parent == current:
+            break
+        current = parent
+    return [str(get_env_file()), *reversed(project_files)], probes
+
+
+def _read_env_file(path):
     env_vars = {}
-    with open(env_file, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
             env_vars[row['key']] = row['value']
+    return env_vars
+
+
+def _load_env_layer_cache():
+    global _env_layer_cache
+    if _env_layer_cache is None:
+        try:
+            with open(get_env_layers_cache_file(), 'r', encoding='utf-8') as f:
+                _env_layer_cache = json.load(f)
+        except (OSError, ValueError):
+            _env_layer_cache = {}
+    return _env_layer_cache
+
+
+def resolve_env_layers(start=None):
+    """Merged env map for start (default: cwd) and the file each key came from.
+
+    Later layers override earlier ones (keys compare case-insensitively).
+    Results are cached per directory and reused while the stamps of the
+    env files and probed directories are unchanged, so a lookup costs a
+    few stats instead of a directory walk and several CSV parses.
+    """
+    cwd = os.path.abspath(start or os.getcwd())
+    with _env_layer_lock:
+        cache = _load_env_layer_cache()
+        entry = cache.get(cwd)
+        if (entry and entry.get('version') == ENV_LAYER_CACHE_VERSION
+                and all(_completion_stamp(p) == stamp for p, stamp in entry['stamps'].items())):
+            return entry['merged'], entry['sources']
+        return _resolve_env_layers_uncached(cache, cwd)
+
+
+def _resolve_env_layers_uncached(cache, cwd):
+    """Build and cache the merged map for cwd; caller holds _env_layer_lock."""
+    chain, probes = find_env_layers(cwd)
+    # Stamp before reading so a concurrent edit invalidates this entry
+    stamps = {p: _completion_stamp(p) for p in [*probes, *chain]}
+
+    merged = {}
+    sources = {}
+    for path in chain:
+        layer = _read_env_file(path)
+        # Shadow lower layers case-insensitively; within one file every
+        # key is kept and the first case variant wins on lookup, as in
+        # _resolve_env_key_case_insensitive
+        shadowed = {key.lower() for key in layer}
+        for key in [k for k in merged if k.lower() in shadowed]:
+            del merged[key]
+            del sources[key]
+        for key, value in layer.items():
+            merged[key] = value
+            sources[key] = path
+
+    cache.pop(cwd, None)
+    cache[cwd] = {'version': ENV_LAYER_CACHE_VERSION, 'stamps': stamps,
+                  'merged': merged, 'sources': sources}
+    while len(cache) > ENV_LAYER_CACHE_SIZE:
+        cache.pop(next(iter(cache)))
+    try:
+        with atomic_write(get_env_layers_cache_file(), 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+    return merged, sources
+
+
+def load_env_config():
+    """Load the environment map for the current directory.
+
+    Project .tos/tos_env.csv files override the global tos_env.csv.
+    """
+    if _session is not None and _session['env_vars'] is not None:
+        return _session['env_vars']
+
+    ensure_config_exists()
+    env_vars, _ = resolve_env_layers()
     
+    if _session is not None:
+        _session['env_vars'] = env_vars
     return env_vars
 
 
@@ -211,58 +741,102 @@ def _resolve_env_key_case_insensitive(env_vars, name):
 
 
 def add_env_variable(key, value, comment=None, force=False):
-    """Add an environment variable to the CSV file."""
+    """Add an environment variable to the CSV file.
+
+    The read-modify-write runs under a lock so concurrent adds from
+    other processes are not lost.
+    """
     ensure_config_exists()
     env_file = get_env_file()
-    
-    # Read existing entries
-    rows = []
-    key_exists = False
-    
-    with open(env_file, 'r', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['key'] == key:
-                key_exists = True
-                if not force:
-                    return False, f"Environment variable '{key}' already exists with value: {row['value']}"
-                # Skip this row if force=True (will be replaced)
-            else:
-                rows.append(row)
-    
-    # Add the new/updated entry
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    rows.append({
-        'key': key,
-        'value': value,
-        'updated_on': timestamp,
-        'comment': comment or ''
-    })
-    
-    # Write all entries back
-    with open(env_file, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=['key', 'value', 'updated_on', 'comment'])
-        writer.writeheader()
-        writer.writerows(rows)
-    
+
+    with file_lock(env_file):
+        # Read existing entries
+        rows = []
+        key_exists = False
+
+        with open(env_file, 'r', newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                if row['key'] == key:
+                    key_exists = True
+                    if not force:
+                        return False, f"Environment variable '{key}' already exists with value: {row['value']}"
+                    # Skip this row if force=True (will be replaced)
+                else:
+                    rows.append(row)
+
+        # Add the new/updated entry
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows.append({
+            'key': key,
+            'value': value,
+            'updated_on': timestamp,
+            'comment': comment or ''
+        })
+
+        # Write all entries back
+        _write_env_rows(env_file, rows)
+
+    if _session is not None:
+        _session['env_vars'] = None
+
     action = "Updated" if key_exists else "Added"
     return True, f"{action} environment variable '{key}' = '{value}'"
 
 
+def refresh_completion_cache():
+    """Rewrite the completion cache if the env CSV or directories changed."""
+    try:
+        data, fresh = load_completion_data()
+        if fresh:
+            return
+        lines = [COMPLETION_CACHE_VERSION]
+        for name, (path, stamp) in data['stamps'].items():
+            lines.append(f"S\t{name}\t{path}\t{stamp}")
+        for kind, key in (('E', 'env'), ('T', 'templates'), ('P', 'projects')):
+            lines.extend(f"{kind}\t{v}" for v in data[key] if '\t' not in v and '\n' not in v)
+        with atomic_write(get_config_dir() / 'completion_cache.tsv', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+    except Exception:
+        # Completion is best-effort; never fail a command over it
+        pass
+
+
+def _complete_env_keys(ctx, param, incomplete):
+    return _completion_matches(load_completion_data()[0]['env'], incomplete)
+
+
+def _complete_templates(ctx, param, incomplete):
+    return _completion_matches(load_completion_data()[0]['templates'], incomplete)
+
+
+def _complete_wm_projects(ctx, param, incomplete):
+    return _completion_matches(load_completion_data()[0]['projects'], incomplete)
+
+
 @click.group(invoke_without_command=True)
 @click.pass_context
 def cli(ctx):
     """TOS - Personal Swiss knife tool for digital standardization."""
-    # Initialize database on first run
-    init_db()
+    if _session is None:
+        # Initialize database on first run
+        init_db()
+        argv = sys.argv[1:]
+    else:
+        # Running a line from `tos batch` / `tos shell`
+        argv = _session['argv']
     
     # Log the command execution (but not for --help)
-    if ctx.invoked_subcommand and '--help' not in sys.argv:
+    if ctx.invoked_subcommand and '--help' not in argv:
         command = ctx.invoked_subcommand
         # Get arguments (everything after the command)
-        args = ' '.join(sys.argv[2:]) if len(sys.argv) > 2 else ''
+        args = ' '.join(argv[1:]) if len(argv) > 1 else ''
         log_command(command, args)
 
+    # Keep the completion cache current once the command has run
+    if _session is None and ctx.invoked_subcommand:
+        ctx.call_on_close(refresh_completion_cache)
+
 
 @cli.command()
 def info():
@@ -305,8 +879,202 @@ def info():
             click.echo(f"  # Add to ~/.bashrc or ~/.zshrc to persist")
 
 
+# --- Template rendering ------------------------------------------------------
+# Template files and paths may contain {{placeholders}}: project_name, date,
+# datetime, year, author, template, or any key from tos_env.csv (matched
+# case-insensitively). Unknown placeholders are left as they are.
+
+PLACEHOLDER_RE = re.compile(rb'\{\{[ \t]{0,8}([A-Za-z_][\w.-]{0,63})[ \t]{0,8}\}\}')
+PLACEHOLDER_PATH_RE = re.compile(r'\{\{[ \t]{0,8}([A-Za-z_][\w.-]{0,63})[ \t]{0,8}\}\}')
+# Longer than any placeholder PLACEHOLDER_RE can match
+PLACEHOLDER_OVERLAP = 128
+RENDER_CHUNK = 1 << 20
+BINARY_SNIFF_BYTES = 8192
+
+# Per-template render caches loaded in this process: {template: {rel: entry}}
+_render_caches = {}
+_render_caches_dirty = set()
+_render_lock = threading.Lock()
+
+
+def get_render_cache_file(template_name):
+    """Get the cached text/binary flags and placeholder offsets for a template."""
+    return get_config_dir() / 'render_cache' / f'{template_name}.json'
+
+
+def _scan_template_file(path):
+    """Return (is_binary, placeholders) for a template file.
+
+    Binary means a NUL byte in the first 8 KB (git's heuristic).
+    Placeholders are (start, end, name) byte offsets, found by streaming
+    the file in chunks so large files are never read whole.
+    """
+    placeholders = []
+    with open(path, 'rb') as f:
+        buf = f.read(BINARY_SNIFF_BYTES)
+        if b'\0' in buf:
+            return True, []
+        buf_start = 0
+        while True:
+            chunk = f.read(RENDER_CHUNK)
+            eof = not chunk
+            buf += chunk
+            # Matches starting in the overlap are picked up next round
+            cut = len(buf) if eof else max(0, len(buf) - PLACEHOLDER_OVERLAP)
+            for m in PLACEHOLDER_RE.finditer(buf):
+                if m.start() >= cut:
+                    break
+                placeholders.append((buf_start + m.start(), buf_start + m.end(), m.group(1).decode('ascii')))
+            if eof:
+                return False, placeholders
+            buf_start += cut
+            buf = buf[cut:]
+
+
+def get_template_file_info(template_name, src, rel):
+    """Cached (is_binary, placeholders) for a template file.
+
+    Entries are keyed by the file's size and mtime_ns, so a file is only
+    rescanned after it changes.
+    """
+    st = src.stat()
+    with _render_lock:
+        cache = _render_caches.get(template_name)
+        if cache is None:
+            try:
+                with open(get_render_cache_file(template_name), 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+            _render_caches[template_name] = cache
+        entry = cache.get(rel)
+    if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+        return entry[2], [tuple(p) for p in entry[3]]
+
+    is_binary, placeholders = _scan_template_file(src)
+    with _render_lock:
+        _render_caches[template_name][rel] = [st.st_size, st.st_mtime_ns, is_binary, placeholders]
+        _render_caches_dirty.add(template_name)
+    return is_binary, placeholders
+
+
+def save_render_caches():
+    """Write render caches that changed in this process."""
+    with _render_lock:
+        for template_name in _render_caches_dirty:
+            cache_file = get_render_cache_file(template_name)
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                with atomic_write(cache_file, 'w', encoding='utf-8') as f:
+                    json.dump(_render_caches[template_name], f)
+            except OSError:
+                pass
+        _render_caches_dirty.clear()
+
+
+def build_render_context(project_dir, template_name=None):
+    """Variables for rendering templates into project_dir.
+
+    The context is saved in .tos/.vars the first time, so later renders
+    (e.g. `tos sync`) reproduce the same output instead of a new date.
+    """
+    vars_file = Path(project_dir) / '.tos' / '.vars'
+    try:
+        with open(vars_file, 'r', encoding='utf-8') as f:
+            context = json.load(f)
+    except (OSError, ValueError):
+        now = datetime.now()
+        config = load_config_toml()
+        author = (config.get('settings', {}).get('author') or config.get('author')
+                  or os.getenv('USER') or os.getenv('USERNAME') or '')
+        context = {
+            'project_name': Path(project_dir).name,
+            'date': now.strftime('%Y-%m-%d'),
+            'datetime': now.strftime('%Y-%m-%d %H:%M:%S'),
+            'year': now.strftime('%Y'),
+            'author': author,
+        }
+        for key, value in load_env_config().items():
+            context.setdefault(key, value)
+    if template_name:
+        context['template'] = template_name
+    return context
+
+
+def save_render_context(project_dir, context):
+    """Persist the render context in .tos/.vars (first write wins)."""
+    vars_file = Path(project_dir) / '.tos' / '.vars'
+    if vars_file.exists():
+        return
+    vars_file.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_write(vars_file, 'w', encoding='utf-8') as f:
+        json.dump({k: v for k, v in context.items() if k != 'template'}, f, indent=2)
+
+
+def _context_lookup(context, name):
+    """Exact key first, then case-insensitive (env keys); None if unknown."""
+    if name in context:
+        return str(context[name])
+    lname = name.lower()
+    for k, v in context.items():
+        if k.lower() == lname:
+            return str(v)
+    return None
+
+
+def render_path(rel, context):
+    """Substitute placeholders in a relative path.
+
+    Values may be absolute paths (env keys), so separators and drive
+    colons are replaced with '_' to keep each value inside one path
+    component; values that would still escape ('.', '..') are not
+    substituted.
+    """
+    if '{{' not in rel:
+        return rel
+
+    def repl(m):
+        value = _context_lookup(context, m.group(1))
+        if value is None:
+            return m.group(0)
+        value = re.sub(r'[\\/:]', '_', value)
+        return m.group(0) if value in ('', '.', '..') else value
+
+    return PLACEHOLDER_PATH_RE.sub(repl, rel)
+
+
+def render_template_file(template_name, src, rel, dest, context):
+    """Copy a template file to dest, substituting placeholders.
+
+    Binary and placeholder-free files take the plain copy2 fast path
+    (which uses the OS's zero-copy primitives); text files are streamed
+    through using the cached placeholder offsets.
+    """
+    is_binary, placeholders = get_template_file_info(template_name, src, rel)
+    if is_binary or not placeholders:
+        shutil.copy2(src, dest)
+        return
+
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        pos = 0
+        for start, end, name in placeholders:
+            remaining = start - pos
+            while remaining > 0:
+                chunk = fsrc.read(min(RENDER_CHUNK, remaining))
+                if not chunk:
+                    break
+                fdst.write(chunk)
+                remaining -= len(chunk)
+            original = fsrc.read(end - start)
+            value = _context_lookup(context, name)
+            fdst.write(original if value is None else value.encode('utf-8'))
+            pos = end
+        shutil.copyfileobj(fsrc, fdst, RENDER_CHUNK)
+    shutil.copystat(src, dest)
+
+
 @cli.command()
-@click.option('-t', '--template', required=True, help='Template name to initialize')
+@click.option('-t', '--template', required=True, shell_complete=_complete_templates, help='Template name to initialize')
 @click.option('--force', is_flag=True, help='Force initialization even if directory is not empty')
 def init(template, force):
     """Initialize current directory with a template."""
@@ -314,7 +1082,7 @@ def init(template, force):
     template_dir = config_dir / 'templates' / template
     
     if not template_dir.exists():
-        click.echo(f"Error: Template '{template}' not found in {config_dir / 'templates'}", err=True)
+        echo_error(f"Error: Template '{template}' not found in {config_dir / 'templates'}")
         click.echo(f"Available templates: {', '.join([d.name for d in (config_dir / 'templates').iterdir() if d.is_dir()])}")
         return
     
@@ -324,7 +1092,7 @@ def init(template, force):
     existing_items = [item for item in current_dir.iterdir() if item.name != '.tos']
     
     if existing_items and not force:
-        click.echo(f"Error: Directory is not empty ({len(existing_items)} item(s) found)", err=True)
+        echo_error(f"Error: Directory is not empty ({len(existing_items)} item(s) found)")
         click.echo("Use --force to initialize anyway (will overwrite conflicting files)")
         click.echo("\nExisting items:")
         for item in existing_items[:5]:  # Show first 5 items
@@ -338,6 +1106,8 @@ def init(template, force):
     # Create .tos directory
     tos_dir.mkdir(exist_ok=True)
     
+    context = build_render_context(current_dir, template)
+    
     # Copy template contents to current directory
     copied_files = []
     overwritten_files = []
@@ -350,29 +1120,36 @@ def init(template, force):
 
         # Create corresponding directories in both destinations
         for d in dirs:
-            (current_dir / rel_root / d).mkdir(parents=True, exist_ok=True)
-            (tos_dir / rel_root / d).mkdir(parents=True, exist_ok=True)
+            rel_dir = render_path((rel_root / d).as_posix(), context)
+            (current_dir / rel_dir).mkdir(parents=True, exist_ok=True)
+            (tos_dir / rel_dir).mkdir(parents=True, exist_ok=True)
             copied_dirs_count += 1
 
-        # Copy files and track overwrite/new
+        # Copy files (rendering placeholders) and track overwrite/new
         for f in files:
             src_file = root_path / f
-            relative_path = src_file.relative_to(template_dir)
+            template_rel = src_file.relative_to(template_dir).as_posix()
+            relative_path = Path(render_path(template_rel, context))
             dest_file = current_dir / relative_path
 
             file_exists = dest_file.exists()
 
             dest_file.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(src_file, dest_file)
+            render_template_file(template, src_file, template_rel, dest_file, context)
 
             if file_exists:
                 overwritten_files.append(relative_path)
             else:
                 copied_files.append(relative_path)
 
+            # Snapshot the rendered file so status/sync compare like for like
             tos_dest = tos_dir / relative_path
             tos_dest.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(src_file, tos_dest)
+            shutil.copy2(dest_file, tos_dest)
+    
+    save_render_caches()
+    save_render_context(current_dir, context)
+    record_project_template(current_dir, template)
     
     click.echo(f"✓ Initialized '{template}' template in {current_dir}")
     click.echo(f"✓ Created .tos directory")
@@ -443,21 +1220,15 @@ def template_add(name, force):
     template_dest = templates_dir / name
     
     # Check if template already exists
-    if template_dest.exists():
-        if not force:
-            click.echo(f"Error: Template '{name}' already exists", err=True)
-            click.echo(f"Use --force to overwrite (will backup existing template)")
-            return
-        
-        # Backup existing template with timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_name = f"{name}_{timestamp}"
-        backup_dest = templates_dir / backup_name
-        
-        click.echo(f"Backing up existing template to: {backup_name}")
-        shutil.move(str(template_dest), str(backup_dest))
+    if template_dest.exists() and not force:
+        echo_error(f"Error: Template '{name}' already exists")
+        click.echo(f"Use --force to overwrite (will backup existing template)")
+        return
     
-    # Copy current directory to templates
+    # Copy into a staging directory first; it is renamed into place below
+    # so other processes never see a half-copied template
+    staging_dir = Path(tempfile.mkdtemp(dir=config_dir, prefix='.staging-'))
+    staged = staging_dir / name
     try:
         # Get list of files to copy (excluding common ignore patterns)
         ignore_patterns = {'.git', '.venv', '__pycache__', '*.pyc', '.tos', 'node_modules'}
@@ -469,25 +1240,42 @@ def template_add(name, force):
                     ignored.append(file)
             return ignored
         
-        shutil.copytree(current_dir, template_dest, ignore=ignore_func)
+        shutil.copytree(current_dir, staged, ignore=ignore_func)
         
         # Count copied files and directories (includes hidden)
         files_count = 0
         dirs_count = 0
-        for _, dirs, files in os.walk(template_dest):
+        for _, dirs, files in os.walk(staged):
             dirs_count += len(dirs)
             files_count += len(files)
 
+        with file_lock(config_dir / '.locks' / f'template-{name}'):
+            if template_dest.exists():
+                if not force:
+                    echo_error(f"Error: Template '{name}' already exists")
+                    click.echo(f"Use --force to overwrite (will backup existing template)")
+                    return
+
+                # Backup existing template with timestamp
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                backup_name = f"{name}_{timestamp}"
+                backup_dest = templates_dir / backup_name
+
+                click.echo(f"Backing up existing template to: {backup_name}")
+                os.replace(template_dest, backup_dest)
+
+            os.replace(staged, template_dest)
+
         click.echo(f"✓ Template '{name}' created successfully")
         click.echo(f"✓ Copied {files_count} file(s) and {dirs_count} directorie(s) from {current_dir}")
         click.echo(f"✓ Template location: {template_dest}")
         click.echo(f"\nUsage: tos init -t {name}")
         
     except Exception as e:
-        click.echo(f"Error creating template: {e}", err=True)
-        # Clean up partial copy if it exists
-        if template_dest.exists():
-            shutil.rmtree(template_dest)
+        echo_error(f"Error creating template: {e}")
+    finally:
+        # Clean up staging (and any partial copy left in it)
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 
 @cli.group(invoke_without_command=True)
@@ -500,8 +1288,12 @@ def env(ctx):
 
 
 @env.command('list')
-def env_list():
+@click.option('--layers', is_flag=True, help='Show which env file each value comes from')
+def env_list(layers):
     """List all configured environment variables."""
+    if layers:
+        env_list_layers()
+        return
     try:
         env_vars = load_env_config()
         
@@ -520,7 +1312,49 @@ def env_list():
             click.echo(f"{key.ljust(max_key_len)} = {value}")
     
     except Exception as e:
-        click.echo(f"Error loading environment config: {e}", err=True)
+        echo_error(f"Error loading environment config: {e}")
+
+
+def env_list_layers():
+    """Print the env layers for the cwd and the source of every value."""
+    try:
+        ensure_config_exists()
+        chain, _ = find_env_layers()
+        layer_vars = [_read_env_file(path) for path in chain]
+    except Exception as e:
+        echo_error(f"Error loading environment config: {e}")
+        return
+
+    labels = ['global'] + [str(i) for i in range(1, len(chain))]
+    click.echo("Env Layers (lowest precedence first)")
+    click.echo("=" * 40)
+    for label, path in zip(labels, chain):
+        click.echo(f"  [{label}] {path}")
+    click.echo("")
+
+    # key (lower) -> [(label, [(key, value), ...]), ...] in precedence order;
+    # case variants within one file stay together, as in `env list`
+    defined = {}
+    for label, env_vars in zip(labels, layer_vars):
+        for key, value in env_vars.items():
+            layers = defined.setdefault(key.lower(), [])
+            if not layers or layers[-1][0] != label:
+                layers.append((label, []))
+            layers[-1][1].append((key, value))
+
+    if not defined:
+        click.echo("No environment variables configured")
+        return
+
+    max_key_len = max(len(key) for layers in defined.values() for key, _ in layers[-1][1])
+    for lkey in sorted(defined):
+        layers = defined[lkey]
+        label, variants = layers[-1]
+        for key, value in variants:
+            click.echo(f"{key.ljust(max_key_len)} = {value}  [{label}]")
+        for shadowed_label, shadowed in reversed(layers[:-1]):
+            for _, shadowed_value in shadowed:
+                click.echo(f"{'':<{max_key_len}}   overrides [{shadowed_label}] {shadowed_value}")
 
 
 @env.command('add')
@@ -537,15 +1371,15 @@ def env_add(key, value, comment, force):
             click.echo(f"✓ {message}")
             click.echo(f"\nUsage: tos cd {key}")
         else:
-            click.echo(f"Error: {message}", err=True)
+            echo_error(f"Error: {message}")
             click.echo("Use --force to overwrite the existing value")
     
     except Exception as e:
-        click.echo(f"Error adding environment variable: {e}", err=True)
+        echo_error(f"Error adding environment variable: {e}")
 
 
 @env.command('like')
-@click.argument('patterns', nargs=-1, required=True)
+@click.argument('patterns', nargs=-1, required=True, shell_complete=_complete_env_keys)
 def env_like(patterns):
     """Search env variable names by wildcard pattern(s) (case-insensitive).
 
@@ -589,11 +1423,11 @@ def env_like(patterns):
             click.echo(f"{k.ljust(max_key_len)} = {env_vars[k]}")
 
     except Exception as e:
-        click.echo(f"Error filtering environment variables: {e}", err=True)
+        echo_error(f"Error filtering environment variables: {e}")
 
 
 @cli.command()
-@click.argument('env_name')
+@click.argument('env_name', shell_complete=_complete_env_keys)
 def cd(env_name):
     """Change directory to configured environment path.
     
@@ -605,7 +1439,7 @@ def cd(env_name):
 
         match_key = _resolve_env_key_case_insensitive(env_vars, env_name)
         if not match_key:
-            click.echo(f"Error: Environment variable '{env_name}' not found", err=True)
+            echo_error(f"Error: Environment variable '{env_name}' not found")
             click.echo(f"Available: {', '.join(env_vars.keys())}")
             return
 
@@ -627,11 +1461,11 @@ def cd(env_name):
             click.echo(f"# CMD (legacy): tos cd {env_name} | cmd", err=True)
 
     except Exception as e:
-        click.echo(f"Error: {e}", err=True)
+        echo_error(f"Error: {e}")
 
 
 @cli.command()
-@click.argument('env_name')
+@click.argument('env_name', shell_complete=_complete_env_keys)
 def path(env_name):
     """Print only the resolved path for an env name.
 
@@ -649,29 +1483,488 @@ def path(env_name):
         path_value = env_vars[match_key]
         click.echo(path_value)
     except Exception as e:
-        click.echo(f"Error resolving path: {e}", err=True)
+        echo_error(f"Error resolving path: {e}")
         sys.exit(1)
 
 
-@cli.command(context_settings=dict(allow_interspersed_args=True))
-@click.argument('project_name', required=False)
-@click.option('-t', '--template', multiple=True, help='Template(s) to apply (can specify multiple)')
-@click.option('-r', '--recent', 'recent_index', type=int, default=None, help='Open recent project from history (0 is most recent, 1 is second most recent, etc.)')
-def wm(project_name, template, recent_index):
-    """Working memory - manage projects with templates.
-    
-    Usage:
-      tos wm                         - Print working memory location
-      tos wm project1                - Create project1 with default template
-      tos wm project1 -t tmpl1 tmpl2 - Create project1 and apply multiple templates
-      tos wm --recent 0              - Open the most recent project
-      tos wm --recent 1              - Open the second most recent project
-    
-    Assumes 'wm' environment variable exists pointing to working memory location.
+def _env_lookup_table(env_vars):
+    """Return a lowercased key -> path map for shell integration.
+
+    Mirrors _resolve_env_key_case_insensitive: when two keys differ only
+    by case, the first one in the CSV wins.
     """
-    # Handle --recent flag
-    if recent_index is not None:
-        wm_recent_and_open(recent_index)
+    table = {}
+    for k, v in env_vars.items():
+        table.setdefault(k.lower(), v)
+    return table
+
+
+def _posix_quote(value):
+    """Single-quote a string for bash/zsh."""
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def _fish_quote(value):
+    """Single-quote a string for fish."""
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def _pwsh_quote(value):
+    """Single-quote a string for PowerShell."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _shell_init_bash(table, env_file, zsh=False):
+    """Build the bash/zsh integration script.
+
+    When evaluated, each shell copies the env file's mtime onto its own
+    reference file (one `touch` per eval). Jumps then check staleness
+    with the builtin `-nt` test, so they spawn no processes. Inside a
+    project with a .tos/tos_env.csv, or for keys missing from the table,
+    the jump falls back to `tos path` for layered resolution.
+    """
+    shell = 'zsh' if zsh else 'bash'
+    entries = '\n'.join(f"  {_posix_quote(k)} {_posix_quote(v)}" for k, v in sorted(table.items()))
+    if zsh:
+        declare = 'typeset -gA __TOS_ENV\n__TOS_ENV=(\n' + entries + '\n)'
+        lower = '${(L)1}'
+        exists = '(( ${+__TOS_ENV[$key]} ))'
+    else:
+        entries = '\n'.join(f"  [{_posix_quote(k)}]={_posix_quote(v)}" for k, v in sorted(table.items()))
+        declare = 'unset __TOS_ENV\ndeclare -gA __TOS_ENV=(\n' + entries + '\n)'
+        lower = '${1,,}'
+        exists = '[[ -n "${__TOS_ENV[$key]+x}" ]]'
+
+    return f'''# tos shell integration ({shell}) - generated by `tos shell-init {shell}`
+# Add to your ~/.{shell}rc:  eval "$(tos shell-init {shell})"
+{declare}
+__TOS_ENV_FILE={_posix_quote(str(env_file))}
+__TOS_ENV_REF="${{TMPDIR:-/tmp}}/.tos-env-ref.$$"
+command touch -r "$__TOS_ENV_FILE" "$__TOS_ENV_REF" 2>/dev/null
+
+__tos_refresh() {{
+  if [[ ! -e "$__TOS_ENV_REF" || "$__TOS_ENV_FILE" -nt "$__TOS_ENV_REF" ]]; then
+    eval "$(command tos shell-init {shell})"
+  fi
+}}
+
+# True if a project .tos/tos_env.csv applies in $PWD (builtins only)
+__tos_has_overlay() {{
+  local dir="$PWD"
+  while true; do
+    if [[ -f "$dir/.tos/tos_env.csv" && "$dir/.tos/tos_env.csv" != "$__TOS_ENV_FILE" ]]; then
+      return 0
+    fi
+    [[ -z "$dir" || "$dir" == "/" ]] && return 1
+    dir="${{dir%/*}}"
+  done
+}}
+
+__tos_jump() {{
+  if [[ -z "$1" ]]; then
+    echo "Usage: tos cd ENV_NAME" >&2
+    return 1
+  fi
+  __tos_refresh
+  local key="{lower}"
+  if __tos_has_overlay || ! {exists}; then
+    # Project keys: let tos resolve the layers (reports unknown keys)
+    local target
+    target="$(command tos path "$1")" || return 1
+    builtin cd -- "$target"
+    return
+  fi
+  builtin cd -- "${{__TOS_ENV[$key]}}"
+}}
+
+tos() {{
+  if [[ "$1" == "cd" ]]; then
+    __tos_jump "$2"
+    return
+  fi
+  command tos "$@"
+}}
+
+t() {{
+  if [[ "$1" == "cd" ]]; then
+    __tos_jump "$2"
+    return
+  fi
+  command t "$@"
+}}
+
+td() {{
+  __tos_jump "$1"
+}}
+'''
+
+
+def _shell_init_fish(table, env_file, env_mtime):
+    """Build the fish integration script."""
+    keys = ' '.join(_fish_quote(k) for k in sorted(table))
+    values = ' '.join(_fish_quote(table[k]) for k in sorted(table))
+    return f'''# tos shell integration (fish) - generated by `tos shell-init fish`
+# Add to ~/.config/fish/config.fish:  tos shell-init fish | source
+set -g __tos_keys {keys}
+set -g __tos_values {values}
+set -g __tos_env_file {_fish_quote(str(env_file))}
+set -g __tos_env_mtime {env_mtime}
+
+# True if a project .tos/tos_env.csv applies in $PWD (builtins only)
+function __tos_has_overlay
+    set -l dir $PWD
+    while true
+        set -l file "$dir/.tos/tos_env.csv"
+        if test -f $file; and test $file != $__tos_env_file
+            return 0
+        end
+        if test -z "$dir"; or test "$dir" = /
+            return 1
+        end
+        set dir (string replace -r '/[^/]*$' '' -- $dir)
+    end
+end
+
+function __tos_jump
+    if test (count $argv) -lt 1
+        echo "Usage: tos cd ENV_NAME" >&2
+        return 1
+    end
+    if test (path mtime -- $__tos_env_file) != $__tos_env_mtime
+        command tos shell-init fish | source
+    end
+    set -l idx (contains -i -- (string lower -- $argv[1]) $__tos_keys)
+    if __tos_has_overlay; or test -z "$idx"
+        # Project keys: let tos resolve the layers (reports unknown keys)
+        set -l target (command tos path $argv[1]); or return 1
+        builtin cd -- $target
+        return
+    end
+    builtin cd -- $__tos_values[$idx]
+end
+
+function tos --wraps tos
+    if test "$argv[1]" = cd
+        __tos_jump $argv[2..-1]
+        return
+    end
+    command tos $argv
+end
+
+function t --wraps t
+    if test "$argv[1]" = cd
+        __tos_jump $argv[2..-1]
+        return
+    end
+    command t $argv
+end
+
+function td
+    __tos_jump $argv
+end
+'''
+
+
+def _shell_init_pwsh(table, env_file, env_ticks):
+    """Build the PowerShell integration script."""
+    entries = '\n'.join(f"  {_pwsh_quote(k)} = {_pwsh_quote(v)}" for k, v in sorted(table.items()))
+    return f'''# tos shell integration (PowerShell) - generated by `tos shell-init pwsh`
+# Add to your $PROFILE:  tos shell-init pwsh | Out-String | Invoke-Expression
+# Hashtable keys are case-insensitive, matching `tos path`.
+$global:__TosEnv = @{{
+{entries}
+}}
+$global:__TosEnvFile = {_pwsh_quote(str(env_file))}
+$global:__TosEnvTicks = {env_ticks}
+
+# True if a project .tos\\tos_env.csv applies in the current directory
+function global:__TosHasOverlay {{
+  $dir = (Get-Location).ProviderPath
+  while ($dir) {{
+    $file = [System.IO.Path]::Combine($dir, '.tos', 'tos_env.csv')
+    if ([System.IO.File]::Exists($file) -and $file -ne $global:__TosEnvFile) {{ return $true }}
+    $dir = [System.IO.Path]::GetDirectoryName($dir)
+  }}
+  return $false
+}}
+
+function global:__TosJump([string] $EnvName) {{
+  if (-not $EnvName) {{
+    Write-Error 'Usage: tos cd <ENV_NAME>'
+    return
+  }}
+  if ([System.IO.File]::GetLastWriteTimeUtc($global:__TosEnvFile).Ticks -ne $global:__TosEnvTicks) {{
+    $exe = Get-Command tos -CommandType Application -ErrorAction SilentlyContinue | Select-Object -First 1
+    if ($exe) {{ & $exe.Source shell-init pwsh | Out-String | Invoke-Expression }}
+  }}
+  if ((__TosHasOverlay) -or -not $global:__TosEnv.ContainsKey($EnvName)) {{
+    # Project keys: let tos resolve the layers (reports unknown keys)
+    $exe = Get-Command tos -CommandType Application -ErrorAction SilentlyContinue | Select-Object -First 1
+    if (-not $exe) {{
+      Write-Error "Environment variable '$EnvName' not found"
+      return
+    }}
+    $target = & $exe.Source path $EnvName
+    if ($LASTEXITCODE -eq 0 -and $target) {{ Set-Location -LiteralPath $target }}
+    return
+  }}
+  Set-Location -LiteralPath $global:__TosEnv[$EnvName]
+}}
+
+function global:__TosInvoke([string] $Name, [string[]] $Arguments) {{
+  if ($Arguments.Length -ge 1 -and $Arguments[0] -eq 'cd') {{
+    __TosJump $(if ($Arguments.Length -ge 2) {{ $Arguments[1] }} else {{ '' }})
+    return
+  }}
+  $exe = Get-Command $Name -CommandType Application -ErrorAction SilentlyContinue | Select-Object -First 1
+  if ($exe) {{ & $exe.Source @Arguments }} else {{ & python -m main @Arguments }}
+}}
+
+Remove-Item Function:tos -ErrorAction SilentlyContinue | Out-Null
+Remove-Item Function:t -ErrorAction SilentlyContinue | Out-Null
+function global:tos {{ __TosInvoke 'tos' $args }}
+function global:t {{ __TosInvoke 't' $args }}
+function global:td([string] $EnvName) {{ __TosJump $EnvName }}
+'''
+
+
+def _shell_init_cmd(table, env_file, env_time, env_size):
+    """Build a self-refreshing CMD batch file (CMD has no shell functions).
+
+    CMD can only read a file's time as a locale-formatted string (%~t), so
+    the script passes the string it saw to `tos shell-init cmd` through
+    _TOS_ENV_T when it regenerates itself, and compares against that.
+    A freshly written script has no time yet and refreshes on first use.
+    """
+    def esc(value):
+        return value.replace('%', '%%')
+
+    lines = []
+    for k, v in sorted(table.items()):
+        if '"' in k or '"' in v:
+            continue
+        lines.append(f'if /I "%~1"=="{esc(k)}" set "_TARGET={esc(v)}" & goto :jump')
+
+    table_lines = '\n'.join(lines)
+    return f'''@echo off
+REM tos shell integration (cmd) - generated by `tos shell-init cmd`
+REM Save on your PATH:  tos shell-init cmd > "%USERPROFILE%\\bin\\td.cmd"
+REM Usage: td ENV_NAME
+
+setlocal
+if "%~1"=="" (
+  echo Usage: td ENV_NAME
+  exit /b 1
+)
+
+set "_STALE="
+for %%F in ("{esc(str(env_file))}") do (
+  if not "%%~zF"=="{env_size}" set "_STALE=1"
+  if not "%%~tF"=="{esc(env_time)}" set "_STALE=1"
+  set "_TOS_ENV_T=%%~tF"
+)
+if defined _STALE (
+  call tos shell-init cmd > "%~f0.tmp" && move /y "%~f0.tmp" "%~f0" >nul && endlocal && "%~f0" %*
+)
+
+REM Inside a project with .tos\\tos_env.csv, let tos resolve the layers
+set "_DIR=%CD%"
+:walk
+if exist "%_DIR%\\.tos\\tos_env.csv" if /I not "%_DIR%\\.tos\\tos_env.csv"=="{esc(str(env_file))}" goto :layered
+for %%D in ("%_DIR%\\..") do set "_PARENT=%%~fD"
+if /I not "%_PARENT%"=="%_DIR%" (
+  set "_DIR=%_PARENT%"
+  goto :walk
+)
+
+set "_TARGET="
+{table_lines}
+
+:layered
+REM Project or unknown key: `tos path` resolves it (and reports unknown keys)
+set "_TARGET="
+for /f "usebackq delims=" %%i in (`tos path "%~1"`) do set "_TARGET=%%i"
+if defined _TARGET goto :jump
+exit /b 1
+
+:jump
+endlocal & cd /d "%_TARGET%"
+'''
+
+
+SHELL_INIT_SHELLS = ['bash', 'zsh', 'fish', 'pwsh', 'cmd']
+
+
+@cli.command('shell-init')
+@click.argument('shell', type=click.Choice(SHELL_INIT_SHELLS, case_sensitive=False))
+def shell_init(shell):
+    """Print native shell functions for `tos cd` / `td`.
+
+    The current env table is compiled into the script, so jumps run
+    without spawning Python. The table is regenerated only when
+    tos_env.csv changes (e.g. after `tos env add`).
+
+    Examples:
+      eval "$(tos shell-init bash)"
+      tos shell-init fish | source
+      tos shell-init pwsh | Out-String | Invoke-Expression
+    """
+    shell = shell.lower()
+    ensure_config_exists()
+    env_file = get_env_file()
+    st = env_file.stat()
+    # Global keys only: the script is shared by every directory the shell
+    # visits, so project .tos/tos_env.csv overrides don't belong in it
+    env_vars = _read_env_file(env_file)
+
+    table = _env_lookup_table(env_vars)
+    if shell in ('bash', 'zsh'):
+        script = _shell_init_bash(table, env_file, zsh=(shell == 'zsh'))
+    elif shell == 'fish':
+        script = _shell_init_fish(table, env_file, st.st_mtime_ns // 1_000_000_000)
+    elif shell == 'pwsh':
+        # .NET ticks: 100ns intervals since 0001-01-01
+        script = _shell_init_pwsh(table, env_file, st.st_mtime_ns // 100 + 621355968000000000)
+    else:
+        # Set by a td.cmd regenerating itself; see _shell_init_cmd
+        env_time = os.environ.get('_TOS_ENV_T', '')
+        script = _shell_init_cmd(table, env_file, env_time, st.st_size)
+
+    click.echo(script, nl=False)
+
+
+DEFAULT_EDITOR = 'code'
+
+# Editors that need the terminal; these run in the foreground
+TERMINAL_EDITORS = {'vi', 'vim', 'nvim', 'nano', 'emacs', 'hx', 'micro'}
+
+# Resolved editor argv, cached for the life of the process (batch/shell)
+_editor_command = None
+
+
+def get_editor_command():
+    """Resolve the editor command from tos_config.toml (once per process).
+
+    `editor` under [settings] may be a name on PATH (code, cursor, vim)
+    or a full command line such as "subl -n". Project paths are appended.
+    Returns the argv list; argv[0] is the resolved executable, or the
+    configured name if it isn't on PATH.
+    """
+    global _editor_command
+    if _editor_command is None:
+        config = load_config_toml()
+        editor = config.get('settings', {}).get('editor') or config.get('editor') or DEFAULT_EDITOR
+        argv = _shell_split(editor) or [DEFAULT_EDITOR]
+        argv[0] = shutil.which(argv[0]) or argv[0]
+        _editor_command = argv
+    return _editor_command
+
+
+def _batch_command_line(argv):
+    """Command line that runs a .bat/.cmd editor shim through cmd.exe safely.
+
+    CreateProcess runs batch files via cmd.exe, which parses the command
+    line again, and list2cmdline doesn't quote & | ( ) ^. Every argument is
+    double-quoted here (cmd treats those characters literally inside quotes)
+    and delayed expansion is off. Quotes, % and line breaks can't be
+    escaped reliably, so arguments containing them raise ValueError.
+    """
+    for arg in argv:
+        if any(c in arg for c in '"%\r\n'):
+            raise ValueError(f"cannot pass {arg!r} safely to a batch file")
+    inner = ' '.join(f'"{arg}"' for arg in argv)
+    comspec = os.environ.get('COMSPEC', 'cmd.exe')
+    return f'"{comspec}" /d /v:off /s /c "{inner}"'
+
+
+def open_in_editor(paths):
+    """Open one or more paths in the configured editor with a single spawn.
+
+    GUI editors are started detached without a shell and this returns
+    immediately. Returns (success, message).
+    """
+    argv = get_editor_command()
+    name = Path(argv[0]).stem
+    if not shutil.which(argv[0]):
+        return False, f"Editor '{argv[0]}' not found on PATH"
+
+    cmd = argv + [str(p) for p in paths]
+    if os.name == 'nt' and Path(argv[0]).suffix.lower() in ('.bat', '.cmd'):
+        # e.g. VS Code's `code` resolves to code.cmd
+        try:
+            cmd = _batch_command_line(cmd)
+        except ValueError as e:
+            return False, f"Could not start {name}: {e}"
+    try:
+        if name.lower() in TERMINAL_EDITORS:
+            subprocess.call(cmd)
+        elif os.name == 'nt':
+            subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP,
+                close_fds=True,
+            )
+        else:
+            subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True,
+                close_fds=True,
+            )
+    except OSError as e:
+        return False, f"Could not start {name}: {e}"
+    return True, f"Opening in {name}..."
+
+
+def _open_projects(project_paths, no_open=False):
+    """Open project paths in the editor, or print them with --no-open."""
+    if no_open:
+        for project_path in project_paths:
+            click.echo(str(project_path))
+        return
+
+    success, message = open_in_editor(project_paths)
+    if success:
+        click.echo(message)
+    else:
+        click.echo(f"Warning: {message}", err=True)
+
+
+@cli.command(context_settings=dict(allow_interspersed_args=True))
+@click.argument('project_name', required=False, shell_complete=_complete_wm_projects)
+@click.option('-t', '--template', multiple=True, shell_complete=_complete_templates, help='Template(s) to apply (can specify multiple)')
+@click.option('-r', '--recent', 'recent_index', type=int, multiple=True, help='Open recent project from history (0 is most recent, 1 is second most recent, etc.); repeat to open several')
+@click.option('--no-open', is_flag=True, help='Do not launch the editor (print the project path instead)')
+@click.option('-l', '--list', 'list_projects', is_flag=True, help='List projects with size, last activity and templates')
+@click.option('--sort', type=click.Choice(['name', 'size', 'modified']), default='name', help='Sort order for --list')
+@click.option('--reverse', is_flag=True, help='Reverse the --list sort order')
+@click.option('--filter', 'name_filter', default=None, help='Only list projects whose name matches this wildcard pattern')
+@click.option('--json', 'as_json', is_flag=True, help='Print --list output as JSON')
+@click.option('--refresh', is_flag=True, help='Rescan every project instead of using the index')
+def wm(project_name, template, recent_index, no_open, list_projects, sort, reverse, name_filter, as_json, refresh):
+    """Working memory - manage projects with templates.
+    
+    Usage:
+      tos wm                         - Print working memory location
+      tos wm project1                - Create project1 with default template
+      tos wm project1 -t tmpl1 tmpl2 - Create project1 and apply multiple templates
+      tos wm --recent 0              - Open the most recent project
+      tos wm --recent 1              - Open the second most recent project
+      tos wm -r 0 -r 1               - Open both in one editor launch
+      tos wm project1 --no-open      - Create/locate project1 without an editor
+      tos wm --list --sort size      - List projects (-t filters by template)
+    
+    The editor is set by `editor` under [settings] in tos_config.toml.
+    Assumes 'wm' environment variable exists pointing to working memory location.
+    """
+    if list_projects:
+        wm_list(template, sort, reverse, name_filter, as_json, refresh)
+        return
+    
+    # Handle --recent flag
+    if recent_index:
+        wm_recent_and_open(recent_index, no_open=no_open)
         return
     
     # If no project name and no recent flag, show working memory location
@@ -681,14 +1974,14 @@ def wm(project_name, template, recent_index):
             match_key = _resolve_env_key_case_insensitive(env_vars, 'wm')
             
             if not match_key:
-                click.echo("Error: Environment variable 'wm' not found", err=True)
+                echo_error("Error: Environment variable 'wm' not found")
                 click.echo("Set it up with: tos env add -k wm -v <path>", err=True)
                 return
             
             wm_path = env_vars[match_key]
             click.echo(wm_path)
         except Exception as e:
-            click.echo(f"Error: {e}", err=True)
+            echo_error(f"Error: {e}")
         return
     
     # Create project with optional templates
@@ -697,7 +1990,7 @@ def wm(project_name, template, recent_index):
         match_key = _resolve_env_key_case_insensitive(env_vars, 'wm')
         
         if not match_key:
-            click.echo("Error: Environment variable 'wm' not found", err=True)
+            echo_error("Error: Environment variable 'wm' not found")
             click.echo("Set it up with: tos env add -k wm -v <path>", err=True)
             return
         
@@ -707,11 +2000,7 @@ def wm(project_name, template, recent_index):
         # Check if project already exists
         if project_path.exists():
             click.echo(f"Project '{project_name}' already exists")
-            click.echo(f"Opening in VS Code...")
-            try:
-                os.system(f'code "{str(project_path)}"')
-            except Exception as e:
-                click.echo(f"Warning: Could not open in VS Code: {e}", err=True)
+            _open_projects([project_path], no_open)
             return
         
         # Create project directory
@@ -734,65 +2023,67 @@ def wm(project_name, template, recent_index):
             
             # Copy template to project directory (similar to init command)
             try:
+                context = build_render_context(project_path, tmpl)
                 for item in template_dir.rglob('*'):
                     if item.is_file():
                         try:
-                            relative_path = item.relative_to(template_dir)
+                            template_rel = item.relative_to(template_dir).as_posix()
+                            relative_path = Path(render_path(template_rel, context))
                             dest_file = project_path / relative_path
                             dest_file.parent.mkdir(parents=True, exist_ok=True)
-                            shutil.copy2(str(item), str(dest_file))
+                            render_template_file(tmpl, item, template_rel, dest_file, context)
+                            # Keep the .tos snapshot like init does (used by status/sync)
+                            tos_dest = project_path / '.tos' / relative_path
+                            tos_dest.parent.mkdir(parents=True, exist_ok=True)
+                            shutil.copy2(str(dest_file), str(tos_dest))
                         except Exception as file_err:
                             click.echo(f"Warning: Could not copy file {item.name}: {file_err}", err=True)
                             continue
                 
+                save_render_caches()
+                save_render_context(project_path, context)
+                record_project_template(project_path, tmpl)
                 click.echo(f"[OK] Applied template '{tmpl}'")
                 applied_count += 1
             except Exception as e:
-                click.echo(f"Error applying template '{tmpl}': {e}", err=True)
+                echo_error(f"Error applying template '{tmpl}': {e}")
         
         click.echo(f"[OK] Project '{project_name}' initialized")
         
         if applied_count > 0:
-            click.echo(f"Opening in VS Code...")
-            try:
-                os.system(f'code "{str(project_path)}"')
-            except Exception as e:
-                click.echo(f"Warning: Could not open in VS Code: {e}", err=True)
+            _open_projects([project_path], no_open)
         
     except Exception as e:
-        click.echo(f"Error creating project: {e}", err=True)
+        echo_error(f"Error creating project: {e}")
         import traceback
         traceback.print_exc()
 
 
-def wm_recent_and_open(index=0):
-    """Open a recent project from history by index (0 = most recent).
+def wm_recent_and_open(indexes=(0,), no_open=False):
+    """Open recent projects from history by index (0 = most recent).
     
-    Extracts the project name from the most recent wm command arguments
-    and opens that project in VS Code.
+    Extracts the project name from the matching wm command arguments
+    and opens the projects in the configured editor with one launch.
     
     Args:
-        index: 0 for most recent, 1 for second most recent, etc.
+        indexes: 0 for most recent, 1 for second most recent, etc.
+        no_open: Print the project paths instead of launching the editor.
     """
     try:
         db_file = get_db_file()
         
         if not db_file.exists():
-            click.echo("No history available yet.", err=True)
+            echo_error("No history available yet.")
             return
         
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        
-        # Query for wm command history, ordered most recent first
-        cursor.execute(
-            "SELECT timestamp, command, arguments, working_directory, status FROM command_history WHERE command = 'wm' ORDER BY timestamp DESC LIMIT 50"
-        )
-        rows = cursor.fetchall()
-        conn.close()
+        with history_connection() as conn:
+            # Query for wm command history, ordered most recent first
+            rows = conn.execute(
+                "SELECT timestamp, command, arguments, working_directory, status FROM command_history WHERE command = 'wm' ORDER BY timestamp DESC, id DESC LIMIT 50"
+            ).fetchall()
         
         if not rows:
-            click.echo("No wm command history found.", err=True)
+            echo_error("No wm command history found.")
             return
         
         # Filter out entries where arguments don't contain a project name
@@ -805,63 +2096,69 @@ def wm_recent_and_open(index=0):
                 project_entries.append((timestamp, args, working_dir, status))
         
         if not project_entries:
-            click.echo("No project history found.", err=True)
+            echo_error("No project history found.")
             return
         
-        # Check if requested index is valid
-        if index >= len(project_entries):
-            click.echo(f"Error: Index {index} out of range (only {len(project_entries)} project(s) in history)", err=True)
-            return
-        
-        # Get the entry at the specified index
-        timestamp, args, working_dir, status = project_entries[index]
-        
-        # Extract project name (first non-flag argument)
-        project_name = None
-        parts = args.split()
-        for part in parts:
-            if not part.startswith('-'):
-                project_name = part
-                break
-        
-        if not project_name:
-            click.echo(f"Error: Could not extract project name from arguments: {args}", err=True)
-            return
-        
-        # Now open the project (similar to the main wm function)
         try:
             env_vars = load_env_config()
             match_key = _resolve_env_key_case_insensitive(env_vars, 'wm')
             
             if not match_key:
-                click.echo("Error: Environment variable 'wm' not found", err=True)
+                echo_error("Error: Environment variable 'wm' not found")
                 return
             
             wm_path = Path(env_vars[match_key])
+        except Exception as e:
+            echo_error(f"Error: {e}")
+            return
+        
+        project_paths = []
+        for index in indexes:
+            # Check if requested index is valid
+            if index >= len(project_entries):
+                echo_error(f"Error: Index {index} out of range (only {len(project_entries)} project(s) in history)")
+                continue
+            
+            # Get the entry at the specified index
+            timestamp, args, working_dir, status = project_entries[index]
+            
+            # Extract project name (first non-flag argument)
+            project_name = None
+            parts = args.split()
+            for part in parts:
+                if not part.startswith('-'):
+                    project_name = part
+                    break
+            
+            if not project_name:
+                echo_error(f"Error: Could not extract project name from arguments: {args}")
+                continue
+            
             project_path = wm_path / project_name
             
             if not project_path.exists():
-                click.echo(f"Error: Project '{project_name}' not found at {project_path}", err=True)
-                return
+                echo_error(f"Error: Project '{project_name}' not found at {project_path}")
+                continue
             
-            click.echo(f"Opening project '{project_name}' (from history index {index})...")
-            try:
-                os.system(f'code "{str(project_path)}"')
-            except Exception as e:
-                click.echo(f"Warning: Could not open in VS Code: {e}", err=True)
+            click.echo(f"Project '{project_name}' (from history index {index})")
+            project_paths.append(project_path)
         
-        except Exception as e:
-            click.echo(f"Error: {e}", err=True)
+        if project_paths:
+            _open_projects(project_paths, no_open)
         
     except Exception as e:
-        click.echo(f"Error reading history: {e}", err=True)
+        echo_error(f"Error reading history: {e}")
 
 
-@cli.command()
+@cli.group(invoke_without_command=True)
 @click.option('--limit', default=None, type=int, help='Number of entries to show (overrides config)')
 @click.option('--command', default=None, help='Filter by command name')
-def history(limit, command):
+@click.option('--machine', default=None, help='Filter by machine id')
+@click.pass_context
+def history(ctx, limit, command, machine):
     """Show command execution history."""
+    if ctx.invoked_subcommand is not None:
+        return
     try:
         db_file = get_db_file()
         
@@ -874,23 +2171,25 @@ def history(limit, command):
             config = load_config_toml()
             limit = config.get('history_limit', 100)
         
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        
         # Build query
         query = "SELECT timestamp, command, arguments, working_directory, status FROM command_history"
         params = []
         
+        conditions = []
         if command:
-            query += " WHERE command = ?"
+            conditions.append("command = ?")
             params.append(command)
+        if machine:
+            conditions.append("machine_id = ?")
+            params.append(machine)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
         
-        query += " ORDER BY timestamp DESC LIMIT ?"
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
         params.append(limit)
         
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        with history_connection() as conn:
+            rows = conn.execute(query, params).fetchall()
         
         if not rows:
             if command:
@@ -922,9 +2221,1195 @@ def history(limit, command):
         
         if command:
             click.echo(f"Filtered by command: {command}")
+        if machine:
+            click.echo(f"Filtered by machine: {machine}")
         
     except Exception as e:
-        click.echo(f"Error reading history: {e}", err=True)
+        echo_error(f"Error reading history: {e}")
+
+
+def merge_history_db(conn, source, default_machine):
+    """Merge one history DB into the connection's main database.
+
+    Runs as a single INSERT ... SELECT over the ATTACHed source inside one
+    transaction. Only rows past the source's high-water mark are read, and
+    rows already present (same timestamp, command, arguments, directory
+    and machine) are skipped, so re-running a merge is a no-op.
+    Returns (rows_read, rows_inserted).
+    """
+    source_key = str(source)
+    conn.execute("ATTACH DATABASE ? AS src", (source_key,))
+    try:
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM src.sqlite_master WHERE type = 'table'")]
+        if 'command_history' not in tables:
+            raise ValueError("not a tos history database (no command_history table)")
+        columns = [row[1] for row in conn.execute("PRAGMA src.table_info(command_history)")]
+        machine_expr = "COALESCE(s.machine_id, :machine)" if 'machine_id' in columns else ":machine"
+
+        with conn:
+            row = conn.execute("SELECT last_id FROM history_merge_state WHERE source = ?",
+                               (source_key,)).fetchone()
+            last_id = row[0] if row else 0
+            max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM src.command_history").fetchone()[0]
+            if max_id < last_id:
+                # Source was recreated; dedup makes a full rescan safe
+                last_id = 0
+
+            rows_read = conn.execute("SELECT COUNT(*) FROM src.command_history WHERE id > ?",
+                                     (last_id,)).fetchone()[0]
+            before = conn.total_changes
+            conn.execute(f'''
+                INSERT INTO main.command_history
+                    (timestamp, command, arguments, working_directory, status, machine_id)
+                SELECT s.timestamp, s.command, s.arguments, s.working_directory, s.status, {machine_expr}
+                FROM src.command_history s
+                WHERE s.id > :last_id
+                  AND NOT EXISTS (
+                    SELECT 1 FROM main.command_history h
+                    WHERE h.timestamp = s.timestamp
+                      AND h.command = s.command
+                      AND h.arguments IS s.arguments
+                      AND h.working_directory IS s.working_directory
+                      AND h.machine_id IS {machine_expr}
+                  )
+                ORDER BY s.id
+            ''', {'machine': default_machine, 'last_id': last_id})
+            inserted = conn.total_changes - before
+
+            conn.execute('''
+                INSERT INTO history_merge_state (source, last_id, merged_on)
+                VALUES (?, ?, ?)
+                ON CONFLICT(source) DO UPDATE SET last_id = excluded.last_id, merged_on = excluded.merged_on
+            ''', (source_key, max_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    finally:
+        conn.execute("DETACH DATABASE src")
+
+    return rows_read, inserted
+
+
+@history.command('merge')
+@click.argument('sources', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--machine-id', default=None,
+              help='Machine id for source rows that have none (default: the source folder name)')
+def history_merge(sources, machine_id):
+    """Merge history databases from other machines into this one.
+
+    Each source is merged in its own transaction and remembers how far it
+    got, so merging the same files again only picks up new entries.
+
+    Examples:
+      tos history merge //share/laptop/tos_history.db
+      tos history merge a/tos_history.db b/tos_history.db
+    """
+    init_db()
+    db_file = get_db_file()
+    conn = sqlite3.connect(db_file)
+    # Room for the index pages a large merge touches
+    conn.execute("PRAGMA cache_size = -262144")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    try:
+        total = 0
+        for source in sources:
+            source_path = Path(source).resolve()
+            if source_path == db_file.resolve():
+                click.echo(f"Skipping {source}: it is the local history database", err=True)
+                continue
+            default_machine = machine_id or source_path.parent.name or source_path.stem
+            start = time.perf_counter()
+            try:
+                rows_read, inserted = merge_history_db(conn, source_path, default_machine)
+            except (sqlite3.Error, ValueError) as e:
+                echo_error(f"Error merging {source}: {e}")
+                continue
+            elapsed = time.perf_counter() - start
+            total += inserted
+            click.echo(f"{source}: {inserted} new of {rows_read} read "
+                       f"({rows_read - inserted} already present) in {elapsed:.2f}s")
+        click.echo(f"Merged {total} entries into {db_file}")
+    finally:
+        conn.close()
+
+
+def _split_command_line(line):
+    """Split a batch/shell line into argv; a leading `tos`/`t` is dropped."""
+    argv = _shell_split(line)
+    if argv and argv[0] in ('tos', 't'):
+        argv = argv[1:]
+    return argv
+
+
+def _start_session():
+    """Open the shared DB connection and state for batch/shell mode."""
+    global _session
+    init_db()
+    _session = {
+        'conn': sqlite3.connect(get_db_file()),
+        'history': [],
+        'argv': [],
+        'env_vars': None,
+        'error': None,
+        # Where the current line's history row starts in the queue, and
+        # its row id if a history read flushed it mid-line
+        'line_start': 0,
+        'line_rowid': None,
+    }
+
+
+def _flush_session_history():
+    """Write queued history rows in a single transaction."""
+    if _session is None or not _session['history']:
+        return
+    line_logged = len(_session['history']) > _session['line_start']
+    try:
+        with _session['conn']:
+            machine_id = get_machine_id()
+            _session['conn'].executemany('''
+                INSERT INTO command_history (timestamp, command, arguments, working_directory, status, machine_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [entry + (machine_id,) for entry in _session['history']])
+            if line_logged:
+                _session['line_rowid'] = _session['conn'].execute("SELECT last_insert_rowid()").fetchone()[0]
+    except sqlite3.Error as e:
+        click.echo(f"Warning: Could not write history: {e}", err=True)
+    _session['history'] = []
+    _session['line_start'] = 0
+
+
+def _end_session():
+    """Flush history and close the shared connection."""
+    global _session
+    _flush_session_history()
+    _session['conn'].close()
+    _session = None
+    refresh_completion_cache()
+
+
+def _run_session_line(argv):
+    """Run one command through the click group.
+
+    Returns None on success or an error message. Errors are reported but
+    never propagate, so the caller decides whether to continue.
+    """
+    _session['argv'] = argv
+    _session['error'] = None
+    _session['line_start'] = len(_session['history'])
+    _session['line_rowid'] = None
+    error = None
+    try:
+        cli.main(args=argv, prog_name='tos', standalone_mode=False)
+    except click.exceptions.Exit as e:
+        if e.exit_code:
+            error = f"exit code {e.exit_code}"
+    except click.ClickException as e:
+        e.show()
+        error = e.format_message()
+    except click.Abort:
+        error = "aborted"
+    except SystemExit as e:
+        if e.code:
+            error = f"exit code {e.code}"
+    except Exception as e:
+        click.echo(f"Error: {e}", err=True)
+        error = str(e)
+    if error is None and _session['error'] is not None:
+        # The command reported an error and returned normally
+        error = re.sub(r'^Error:?\s*', '', _session['error'])
+
+    # Mark the history row for this line as failed
+    if error:
+        if len(_session['history']) > _session['line_start']:
+            _session['history'][-1] = _session['history'][-1][:4] + ('error',)
+        elif _session['line_rowid'] is not None:
+            with _session['conn']:
+                _session['conn'].execute("UPDATE command_history SET status = 'error' WHERE id = ?",
+                                         (_session['line_rowid'],))
+    return error
+
+
+def _check_not_nested():
+    if _session is not None:
+        raise click.ClickException("batch/shell cannot be nested")
+
+
+@cli.command()
+@click.argument('script', type=click.File('r', encoding='utf-8'))
+@click.option('--fail-fast', is_flag=True, help='Stop at the first failing line')
+def batch(script, fail_fast):
+    """Run many tos commands in one process.
+
+    Reads one command per line from SCRIPT (or stdin with `-`). Blank
+    lines and lines starting with # are skipped; a leading `tos` is
+    optional. History for the whole batch is written in one transaction
+    (earlier if a line reads history, e.g. `wm -r 0`).
+
+    Examples:
+      tos batch setup.txt
+      cat setup.txt | tos batch - --fail-fast
+    """
+    _check_not_nested()
+    _start_session()
+    ran = 0
+    failed = 0
+    try:
+        for line_no, line in enumerate(script, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                argv = _split_command_line(line)
+            except ValueError as e:
+                argv = None
+                error = f"could not parse line: {e}"
+            else:
+                if not argv:
+                    continue
+                error = _run_session_line(argv)
+            ran += 1
+            if error:
+                failed += 1
+                click.echo(f"Error (line {line_no}): {error}", err=True)
+                if fail_fast:
+                    break
+    finally:
+        _end_session()
+
+    click.echo(f"Ran {ran} command(s), {failed} failed", err=True)
+    if failed:
+        mark_command_failed()
+        sys.exit(1)
+
+
+@cli.command('shell')
+def shell_repl():
+    """Interactive tos prompt (commands run in one process).
+
+    Type commands without the `tos` prefix; `exit`, `quit` or Ctrl-D
+    leaves the shell.
+    """
+    _check_not_nested()
+    try:
+        import readline  # noqa: F401 - enables line editing/history
+    except ImportError:
+        pass
+
+    _start_session()
+    try:
+        while True:
+            try:
+                line = input('tos> ').strip()
+            except EOFError:
+                click.echo()
+                break
+            except KeyboardInterrupt:
+                click.echo()
+                continue
+
+            if not line or line.startswith('#'):
+                continue
+            if line in ('exit', 'quit'):
+                break
+            try:
+                argv = _split_command_line(line)
+            except ValueError as e:
+                click.echo(f"Error: could not parse line: {e}", err=True)
+                continue
+            if argv:
+                _run_session_line(argv)
+                _flush_session_history()
+    finally:
+        _end_session()
+
+
+STATUS_RACY_NS = 2_000_000_000
+
+
+def get_status_cache_file():
+    """Get the stat cache used by `tos status`."""
+    return get_config_dir() / 'status_cache.db'
+
+
+def get_wm_dir():
+    """Return the working memory directory from the 'wm' env key, or None."""
+    env_vars = load_env_config()
+    match_key = _resolve_env_key_case_insensitive(env_vars, 'wm')
+    return Path(env_vars[match_key]) if match_key else None
+
+
+def find_project_root(start=None):
+    """Walk up from start (default: cwd) to the nearest dir with a .tos/ snapshot.
+
+    The TOS config directory itself (~/.tos by default) is not a snapshot.
+    """
+    config_dir = get_config_dir().resolve()
+    current = Path(start or Path.cwd()).resolve()
+    for candidate in [current, *current.parents]:
+        tos_dir = candidate / '.tos'
+        if tos_dir.is_dir() and tos_dir.resolve() != config_dir:
+            return candidate
+    return None
+
+
+def _stat_key(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+# Bookkeeping files inside .tos/ that are not part of the template snapshot
+SNAPSHOT_META_FILES = {'.templates', '.vars', 'tos_env.csv'}
+
+
+def read_project_templates(project_dir):
+    """Template names recorded in <project>/.tos/.templates (in apply order)."""
+    meta_file = Path(project_dir) / '.tos' / '.templates'
+    try:
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def record_project_template(project_dir, template_name):
+    """Remember that template_name was applied to project_dir."""
+    names = read_project_templates(project_dir)
+    if template_name in names:
+        return
+    meta_file = Path(project_dir) / '.tos' / '.templates'
+    meta_file.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_write(meta_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(names + [template_name]) + '\n')
+
+
+def _files_equal(a, b, size):
+    """Compare two files of the same size chunk by chunk."""
+    if size == 0:
+        return True
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            chunk_a = fa.read(1 << 20)
+            if chunk_a != fb.read(1 << 20):
+                return False
+            if not chunk_a:
+                return True
+
+
+def _iter_snapshot_files(snapshot_dir):
+    """Yield (relative posix path, snapshot file) for every file in .tos/."""
+    for root, dirs, files in os.walk(snapshot_dir):
+        root_path = Path(root)
+        for f in files:
+            if root_path == snapshot_dir and f in SNAPSHOT_META_FILES:
+                continue
+            snap_file = root_path / f
+            yield snap_file.relative_to(snapshot_dir).as_posix(), snap_file
+
+
+def project_status(project_dir, cached):
+    """Compare a project's files with its .tos/ snapshot.
+
+    `cached` maps relative path -> (stat key, state) from a previous run.
+    Files whose snapshot and project stats (size, mtime_ns, inode) are
+    unchanged reuse the cached state; only the rest are read. Returns
+    (modified, deleted, tracked_count, rows) where rows are the cache
+    entries to keep. Files touched within the last couple of seconds are
+    not cached, since a same-mtime edit could go unnoticed (git's "racy"
+    case).
+    """
+    snapshot_dir = project_dir / '.tos'
+    racy_after = time.time_ns() - STATUS_RACY_NS
+    modified = []
+    deleted = []
+    rows = []
+    tracked = 0
+
+    for rel, snap_file in _iter_snapshot_files(snapshot_dir):
+        tracked += 1
+        try:
+            snap_st = snap_file.stat()
+            proj_st = (project_dir / rel).stat()
+        except FileNotFoundError:
+            deleted.append(rel)
+            continue
+
+        key = _stat_key(snap_st) + _stat_key(proj_st)
+        entry = cached.get(rel)
+        if entry and entry[0] == key:
+            state = entry[1]
+        elif snap_st.st_size != proj_st.st_size:
+            state = 'modified'
+        else:
+            same = _files_equal(snap_file, project_dir / rel, snap_st.st_size)
+            state = 'clean' if same else 'modified'
+
+        if state == 'modified':
+            modified.append(rel)
+        if max(snap_st.st_mtime_ns, proj_st.st_mtime_ns) < racy_after:
+            rows.append((rel, key, state))
+
+    return sorted(modified), sorted(deleted), tracked, rows
+
+
+def _open_status_cache():
+    conn = sqlite3.connect(get_status_cache_file())
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS status_cache (
+            project TEXT NOT NULL,
+            path TEXT NOT NULL,
+            stat TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (project, path)
+        )
+    ''')
+    return conn
+
+
+def check_projects_status(project_dirs, max_workers=None):
+    """Run project_status() over many projects concurrently.
+
+    Returns {project_dir: (modified, deleted, tracked)} and writes the
+    refreshed stat cache in one transaction.
+    """
+    conn = _open_status_cache()
+    keys = {str(p) for p in project_dirs}
+    cached = {k: {} for k in keys}
+    for project, rel, stat, state in conn.execute('SELECT project, path, stat, state FROM status_cache'):
+        if project in cached:
+            cached[project][rel] = (tuple(json.loads(stat)), state)
+
+    results = {}
+    updates = {}
+    workers = max_workers or min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(project_status, p, cached[str(p)]): p for p in project_dirs}
+        for future in as_completed(futures):
+            project_dir = futures[future]
+            try:
+                modified, deleted, tracked, rows = future.result()
+            except OSError as e:
+                click.echo(f"Warning: Could not check {project_dir}: {e}", err=True)
+                continue
+            results[project_dir] = (modified, deleted, tracked)
+            updates[str(project_dir)] = rows
+
+    with conn:
+        for project, rows in updates.items():
+            conn.execute('DELETE FROM status_cache WHERE project = ?', (project,))
+            conn.executemany(
+                'INSERT INTO status_cache (project, path, stat, state) VALUES (?, ?, ?, ?)',
+                [(project, rel, json.dumps(key), state) for rel, key, state in rows]
+            )
+    conn.close()
+    return results
+
+
+def list_wm_projects(wm_dir):
+    """Projects under the wm directory that have a .tos/ snapshot."""
+    projects = []
+    with os.scandir(wm_dir) as it:
+        for entry in it:
+            if entry.is_dir() and not entry.name.startswith('.') and os.path.isdir(os.path.join(entry.path, '.tos')):
+                projects.append(Path(entry.path))
+    return sorted(projects, key=lambda p: p.name.lower())
+
+
+@cli.command()
+@click.option('--all', 'check_all', is_flag=True, help='Check every project under the wm directory')
+def status(check_all):
+    """Show template-managed files changed since `tos init`.
+
+    Compares project files with the .tos/ snapshot taken when the
+    template was applied and reports modified and deleted files.
+    """
+    try:
+        if check_all:
+            wm_dir = get_wm_dir()
+            if wm_dir is None:
+                echo_error("Error: Environment variable 'wm' not found")
+                click.echo("Set it up with: tos env add -k wm -v <path>", err=True)
+                return
+            projects = list_wm_projects(wm_dir)
+            if not projects:
+                click.echo(f"No projects with a .tos snapshot in {wm_dir}")
+                return
+        else:
+            project_dir = find_project_root()
+            if project_dir is None:
+                echo_error("Error: Not inside a project initialized by tos (no .tos directory found)")
+                return
+            projects = [project_dir]
+
+        results = check_projects_status(projects)
+    except Exception as e:
+        echo_error(f"Error checking status: {e}")
+        return
+
+    if not check_all:
+        project_dir = projects[0]
+        modified, deleted, tracked = results.get(project_dir, ([], [], 0))
+        click.echo(f"Project: {project_dir}")
+        for rel in modified:
+            click.echo(f"  modified: {rel}")
+        for rel in deleted:
+            click.echo(f"  deleted:  {rel}")
+        if modified or deleted:
+            click.echo(f"\n{tracked} tracked file(s): {len(modified)} modified, {len(deleted)} deleted")
+        else:
+            click.echo(f"✓ {tracked} tracked file(s), no changes")
+        return
+
+    name_width = max(len(p.name) for p in projects)
+    dirty = 0
+    for project_dir in projects:
+        if project_dir not in results:
+            continue
+        modified, deleted, tracked = results[project_dir]
+        if modified or deleted:
+            dirty += 1
+            click.echo(f"{project_dir.name.ljust(name_width)}  {len(modified)} modified, {len(deleted)} deleted")
+            for rel in modified:
+                click.echo(f"    modified: {rel}")
+            for rel in deleted:
+                click.echo(f"    deleted:  {rel}")
+        else:
+            click.echo(f"{project_dir.name.ljust(name_width)}  clean")
+    click.echo(f"\n{len(projects)} project(s), {dirty} with changes")
+
+
+def _same_file_content(a, b):
+    """True if both files exist with identical contents."""
+    try:
+        size_a = a.stat().st_size
+        if size_a != b.stat().st_size:
+            return False
+    except FileNotFoundError:
+        return False
+    return _files_equal(a, b, size_a)
+
+
+def sync_project(project_dir, template_names, dry_run=False):
+    """Three-way update of a project from its templates.
+
+    base = .tos/ snapshot, theirs = current template, ours = project.
+    Files the template didn't change are skipped; files changed in the
+    template are copied when the project copy is untouched (ours == base)
+    or missing from both; anything edited locally is left alone and
+    reported as a conflict. The snapshot is updated for every file taken.
+    When several templates provide the same path, the last one in apply
+    order (.tos/.templates) owns it and is the only one compared.
+    Returns a dict with 'updated', 'added', 'conflicts', 'removed' (paths
+    the template no longer has, now untracked) and 'bytes'.
+    """
+    snapshot_dir = project_dir / '.tos'
+    templates_dir = get_config_dir() / 'templates'
+    summary = {'updated': [], 'added': [], 'conflicts': [], 'removed': [], 'bytes': 0}
+    template_files = set()
+    # Read before this sync records anything; empty for legacy projects
+    recorded_order = read_project_templates(project_dir)
+    recorded = set(recorded_order)
+
+    for name in template_names:
+        if not (templates_dir / name).is_dir():
+            raise FileNotFoundError(f"Template '{name}' not found")
+
+    # Owner of each rendered path: the last template to provide it. Recorded
+    # templates that aren't being synced still own their paths.
+    apply_order = recorded_order + [n for n in template_names if n not in recorded]
+    owners = {}
+    template_entries = {}
+    for name in apply_order:
+        template_dir = templates_dir / name
+        if not template_dir.is_dir():
+            continue
+        context = build_render_context(project_dir, name)
+        entries = [(template_rel, src, render_path(template_rel, context))
+                   for template_rel, src in _iter_snapshot_files(template_dir)]
+        template_entries[name] = (context, entries)
+        for _, _, rel in entries:
+            owners[rel] = name
+
+    for name in template_names:
+        context, entries = template_entries[name]
+        for template_rel, src, rel in entries:
+            template_files.add(rel)
+            if owners[rel] != name:
+                continue  # a later template provides this path
+            base = snapshot_dir / rel
+            ours = project_dir / rel
+            base_exists = base.exists()
+
+            # Compare against the template as it would be rendered for
+            # this project (same saved context, so unchanged files match)
+            is_binary, placeholders = get_template_file_info(name, src, template_rel)
+            rendered = None
+            if placeholders and not is_binary:
+                fd, tmp_name = tempfile.mkstemp(prefix='.tos-sync-', suffix='.tmp')
+                os.close(fd)
+                rendered = Path(tmp_name)
+                render_template_file(name, src, template_rel, rendered, context)
+            theirs = rendered or src
+
+            try:
+                if base_exists and _same_file_content(theirs, base):
+                    continue  # template unchanged
+
+                if ours.exists():
+                    if _same_file_content(ours, theirs):
+                        action = None  # already up to date, only refresh base
+                    elif base_exists and _same_file_content(ours, base):
+                        action = 'updated'
+                    else:
+                        summary['conflicts'].append(rel)
+                        continue
+                elif base_exists:
+                    # Deleted locally but changed in the template
+                    summary['conflicts'].append(rel)
+                    continue
+                else:
+                    action = 'added'
+
+                if not dry_run:
+                    if action:
+                        ours.parent.mkdir(parents=True, exist_ok=True)
+                        shutil.copy2(theirs, ours)
+                    base.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy2(theirs, base)
+                if action:
+                    summary[action].append(rel)
+                    summary['bytes'] += theirs.stat().st_size
+            finally:
+                if rendered is not None:
+                    rendered.unlink()
+
+        if not dry_run:
+            save_render_context(project_dir, context)
+
+    # Files dropped from the template stop being template-managed: they
+    # leave the snapshot but the project copy is never deleted. With
+    # several templates the snapshot is shared, so only judge a project
+    # whose recorded templates are all being synced. Projects initialised
+    # before .tos/.templates existed have no record and are never pruned.
+    extra = [(rel, base) for rel, base in _iter_snapshot_files(snapshot_dir)
+             if rel not in template_files]
+    if recorded and recorded <= set(template_names):
+        for rel, base in extra:
+            summary['removed'].append(rel)
+            if not dry_run:
+                base.unlink()
+        summary['removed'].sort()
+
+    # A legacy project is only given a record once it's known to be
+    # complete, i.e. the synced templates account for the whole snapshot
+    if not dry_run and (recorded or not extra):
+        for name in template_names:
+            record_project_template(project_dir, name)
+    return summary
+
+
+def _format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+@cli.command()
+@click.option('-t', '--template', multiple=True, shell_complete=_complete_templates, help='Template(s) to sync (default: templates recorded in .tos)')
+@click.option('--all', 'sync_all', is_flag=True, help='Sync every project under the wm directory')
+@click.option('-j', '--jobs', default=8, type=int, help='Number of projects to sync in parallel (with --all)')
+@click.option('--dry-run', is_flag=True, help='Show what would change without copying')
+def sync(template, sync_all, jobs, dry_run):
+    """Upgrade projects to the current version of their templates.
+
+    Only files changed in the template are copied; files you edited
+    locally are kept and reported as conflicts.
+
+    Examples:
+      tos sync                  - Sync the current project
+      tos sync -t python        - Sync the current project from 'python'
+      tos sync --all -t python  - Sync every wm project that uses 'python'
+    """
+    try:
+        if sync_all:
+            wm_dir = get_wm_dir()
+            if wm_dir is None:
+                echo_error("Error: Environment variable 'wm' not found")
+                click.echo("Set it up with: tos env add -k wm -v <path>", err=True)
+                return
+            projects = list_wm_projects(wm_dir)
+        else:
+            project_dir = find_project_root()
+            if project_dir is None:
+                echo_error("Error: Not inside a project initialized by tos (no .tos directory found)")
+                return
+            projects = [project_dir]
+    except Exception as e:
+        echo_error(f"Error: {e}")
+        return
+
+    # Decide which templates each project gets
+    jobs_list = []
+    for project_dir in projects:
+        recorded = read_project_templates(project_dir)
+        if template:
+            # With --all only touch projects that already use the template
+            names = [t for t in template if t in recorded] if sync_all else list(template)
+        else:
+            names = recorded
+        if names:
+            jobs_list.append((project_dir, names))
+        elif not sync_all:
+            echo_error("Error: No template recorded in .tos for this project; use -t <template>")
+            return
+
+    if not jobs_list:
+        click.echo("No projects to sync")
+        return
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {pool.submit(sync_project, p, names, dry_run): p for p, names in jobs_list}
+        for future in as_completed(futures):
+            project_dir = futures[future]
+            try:
+                results[project_dir] = future.result()
+            except Exception as e:
+                results[project_dir] = e
+    save_render_caches()
+
+    total_bytes = 0
+    conflicted = 0
+    name_width = max(len(p.name) for p, _ in jobs_list)
+    for project_dir, _ in sorted(jobs_list, key=lambda j: j[0].name.lower()):
+        result = results[project_dir]
+        label = project_dir.name.ljust(name_width)
+        if isinstance(result, Exception):
+            echo_error(f"{label}  error: {result}")
+            continue
+
+        total_bytes += result['bytes']
+        changed = len(result['updated']) + len(result['added'])
+        if not changed and not result['conflicts'] and not result['removed']:
+            click.echo(f"{label}  up to date")
+            continue
+
+        click.echo(f"{label}  {len(result['updated'])} updated, {len(result['added'])} added, "
+                   f"{len(result['conflicts'])} conflict(s), {_format_bytes(result['bytes'])}")
+        for rel in result['updated']:
+            click.echo(f"    updated:  {rel}")
+        for rel in result['added']:
+            click.echo(f"    added:    {rel}")
+        for rel in result['conflicts']:
+            click.echo(f"    conflict: {rel} (modified locally, kept)")
+        for rel in result['removed']:
+            click.echo(f"    no longer in template: {rel} (kept, untracked)")
+        if result['conflicts']:
+            conflicted += 1
+
+    prefix = "Would move" if dry_run else "Moved"
+    click.echo(f"\n{len(jobs_list)} project(s) synced, {conflicted} with conflicts. {prefix} {_format_bytes(total_bytes)}")
+
+
+def get_wm_index_file():
+    """Get the wm workspace index path."""
+    return get_config_dir() / 'wm_index.json'
+
+
+def _index_project(project_dir, cached):
+    """Size/activity summary for one project, rescanning only changed dirs.
+
+    `cached` holds per-directory entries [mtime_ns, size, file_count,
+    newest_mtime_ns, subdirs] from the last run. A directory whose mtime
+    is unchanged reuses its entry (one stat instead of a scandir plus a
+    stat per file). In-place edits that don't touch any directory's mtime
+    are picked up on the next change or with --refresh.
+    """
+    old_dirs = cached.get('dirs', {}) if cached else {}
+    templates = cached.get('templates', []) if cached else []
+    new_dirs = {}
+    total_size = 0
+    file_count = 0
+    newest = 0
+
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        path = os.path.join(project_dir, rel) if rel else str(project_dir)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+
+        entry = old_dirs.get(rel)
+        if entry is None or entry[0] != st.st_mtime_ns:
+            size = 0
+            count = 0
+            latest = st.st_mtime_ns
+            subdirs = []
+            try:
+                with os.scandir(path) as it:
+                    for e in it:
+                        try:
+                            if e.is_dir(follow_symlinks=False):
+                                subdirs.append(f"{rel}/{e.name}" if rel else e.name)
+                            else:
+                                est = e.stat(follow_symlinks=False)
+                                size += est.st_size
+                                count += 1
+                                latest = max(latest, est.st_mtime_ns)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+            entry = [st.st_mtime_ns, size, count, latest, subdirs]
+            if rel == '.tos':
+                templates = read_project_templates(project_dir)
+
+        new_dirs[rel] = entry
+        total_size += entry[1]
+        file_count += entry[2]
+        newest = max(newest, entry[3])
+        stack.extend(entry[4])
+
+    if '.tos' not in new_dirs:
+        templates = []
+
+    return {
+        'name': Path(project_dir).name,
+        'path': str(project_dir),
+        'size': total_size,
+        'files': file_count,
+        'modified_ns': newest,
+        'templates': templates,
+        'dirs': new_dirs,
+    }
+
+
+def refresh_wm_index(wm_dir, force=False):
+    """Update the workspace index for wm_dir and return its projects.
+
+    Projects are indexed concurrently; the index is written back with an
+    atomic replace.
+    """
+    index_file = get_wm_index_file()
+    index = {}
+    if not force:
+        try:
+            with open(index_file, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+    if index.get('wm_dir') != str(wm_dir):
+        index = {}
+    cached = index.get('projects', {})
+
+    project_dirs = []
+    with os.scandir(wm_dir) as it:
+        for entry in it:
+            if not entry.name.startswith('.') and entry.is_dir():
+                project_dirs.append(Path(entry.path))
+
+    projects = {}
+    workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for info in pool.map(lambda p: _index_project(p, cached.get(p.name)), project_dirs):
+            projects[info['name']] = info
+
+    if projects != cached:
+        try:
+            with atomic_write(index_file, 'w', encoding='utf-8') as f:
+                json.dump({'wm_dir': str(wm_dir), 'projects': projects}, f)
+        except OSError:
+            pass
+    return list(projects.values())
+
+
+def wm_list(template_filter, sort, reverse, name_filter, as_json, refresh):
+    """Print the projects in the wm directory (`tos wm --list`)."""
+    try:
+        wm_dir = get_wm_dir()
+        if wm_dir is None:
+            echo_error("Error: Environment variable 'wm' not found")
+            click.echo("Set it up with: tos env add -k wm -v <path>", err=True)
+            return
+        projects = refresh_wm_index(wm_dir, force=refresh)
+    except Exception as e:
+        echo_error(f"Error indexing projects: {e}")
+        return
+
+    if name_filter:
+        projects = [p for p in projects if fnmatch.fnmatch(p['name'].lower(), name_filter.lower())]
+    if template_filter:
+        wanted = {t.lower() for t in template_filter}
+        projects = [p for p in projects if wanted & {t.lower() for t in p['templates']}]
+
+    sort_keys = {
+        'name': lambda p: p['name'].lower(),
+        'size': lambda p: p['size'],
+        'modified': lambda p: p['modified_ns'],
+    }
+    projects.sort(key=sort_keys[sort], reverse=reverse)
+
+    rows = [{
+        'name': p['name'],
+        'path': p['path'],
+        'size': p['size'],
+        'files': p['files'],
+        'last_modified': datetime.fromtimestamp(p['modified_ns'] / 1e9).strftime('%Y-%m-%d %H:%M:%S'),
+        'templates': p['templates'],
+    } for p in projects]
+
+    if as_json:
+        click.echo(json.dumps(rows, indent=2))
+        return
+
+    if not rows:
+        click.echo("No projects found.")
+        return
+
+    name_width = max(7, max(len(r['name']) for r in rows))
+    click.echo(f"{'Project':<{name_width}}  {'Size':>10}  {'Files':>6}  {'Last Modified':<19}  Templates")
+    click.echo("=" * (name_width + 54))
+    for r in rows:
+        click.echo(f"{r['name']:<{name_width}}  {_format_bytes(r['size']):>10}  {r['files']:>6}  "
+                   f"{r['last_modified']:<19}  {', '.join(r['templates'])}")
+    click.echo("=" * (name_width + 54))
+    click.echo(f"{len(rows)} project(s) in {wm_dir}")
+
+
+KB_COLUMNS = ['topic', 'content', 'tags', 'updated_on']
+KB_INDEX_VERSION = '1'
+
+
+def get_kb_file():
+    """Get the TOS knowledge base workbook path."""
+    return get_config_dir() / 'kb.xlsx'
+
+
+def get_kb_index_file():
+    """Get the SQLite search index built from kb.xlsx."""
+    return get_config_dir() / 'kb_index.db'
+
+
+def _kb_read_rows(kb_file):
+    """Stream (sheet, row_number, record) tuples from the workbook.
+
+    The first row of every sheet is treated as the header. openpyxl is
+    imported here so other commands don't pay for it.
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(kb_file, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, None)
+            if not header:
+                continue
+            header = [str(h).strip() if h is not None else f'col{i + 1}' for i, h in enumerate(header)]
+            for row_num, values in enumerate(rows, start=2):
+                if all(v is None or str(v).strip() == '' for v in values):
+                    continue
+                record = {h: ('' if v is None else str(v)) for h, v in zip(header, values)}
+                yield ws.title, row_num, record
+    finally:
+        wb.close()
+
+
+def _kb_open_index():
+    """Open the KB index, rebuilding it if kb.xlsx changed.
+
+    The index is keyed by the workbook's mtime and size. Returns
+    (connection, has_fts); has_fts is False when SQLite lacks FTS5 and
+    searches fall back to LIKE.
+    """
+    kb_file = get_kb_file()
+    st = kb_file.stat()
+    stamp = {'version': KB_INDEX_VERSION, 'mtime_ns': str(st.st_mtime_ns), 'size': str(st.st_size)}
+
+    conn = sqlite3.connect(get_kb_index_file())
+    conn.execute('CREATE TABLE IF NOT EXISTS kb_meta (key TEXT PRIMARY KEY, value TEXT)')
+    conn.commit()
+
+    def is_fresh():
+        meta = dict(conn.execute('SELECT key, value FROM kb_meta'))
+        if all(meta.get(k) == v for k, v in stamp.items()):
+            return True, meta.get('fts') == '1'
+        return False, False
+
+    fresh, has_fts = is_fresh()
+    if fresh:
+        return conn, has_fts
+
+    # Serialize rebuilds across processes, then re-check under the lock
+    conn.execute('BEGIN IMMEDIATE')
+    fresh, has_fts = is_fresh()
+    if fresh:
+        conn.commit()
+        return conn, has_fts
+
+    conn.execute('DROP TABLE IF EXISTS kb_fts')
+    conn.execute('DROP TABLE IF EXISTS kb_rows')
+    conn.execute('''
+        CREATE TABLE kb_rows (
+            id INTEGER PRIMARY KEY,
+            sheet TEXT,
+            row_num INTEGER,
+            record TEXT,
+            body TEXT
+        )
+    ''')
+    conn.executemany(
+        'INSERT INTO kb_rows (sheet, row_num, record, body) VALUES (?, ?, ?, ?)',
+        ((sheet, row_num, json.dumps(record), ' '.join(record.values()))
+         for sheet, row_num, record in _kb_read_rows(kb_file))
+    )
+
+    try:
+        conn.execute("CREATE VIRTUAL TABLE kb_fts USING fts5(body, content='kb_rows', content_rowid='id')")
+        conn.execute('INSERT INTO kb_fts (rowid, body) SELECT id, body FROM kb_rows')
+        has_fts = True
+    except sqlite3.OperationalError:
+        has_fts = False
+
+    conn.execute('DELETE FROM kb_meta')
+    conn.executemany('INSERT INTO kb_meta (key, value) VALUES (?, ?)',
+                     list(stamp.items()) + [('fts', '1' if has_fts else '0')])
+    conn.commit()
+    return conn, has_fts
+
+
+def _kb_echo_entry(sheet, row_num, record):
+    """Print one KB row."""
+    click.echo(f"[{sheet}:{row_num}]")
+    for key, value in json.loads(record).items():
+        if value:
+            click.echo(f"  {key}: {value}")
+
+
+@cli.group()
+def kb():
+    """Search and manage the knowledge base (kb.xlsx)."""
+    pass
+
+
+@kb.command('search')
+@click.argument('query', nargs=-1, required=True)
+@click.option('--limit', default=20, type=int, help='Maximum number of results')
+def kb_search(query, limit):
+    """Full-text search the knowledge base.
+
+    Examples:
+      t kb search docker
+      t kb search git rebase
+    """
+    kb_file = get_kb_file()
+    if not kb_file.exists():
+        echo_error(f"KB file not found: {kb_file}")
+        click.echo("Create one with: tos kb add -t <topic> -c <content>", err=True)
+        return
+
+    terms = re.findall(r'\w+', ' '.join(query))
+    if not terms:
+        echo_error("Error: Empty search query")
+        return
+
+    try:
+        conn, has_fts = _kb_open_index()
+        if has_fts:
+            match = ' '.join(f'"{t}"*' for t in terms)
+            rows = conn.execute('''
+                SELECT r.sheet, r.row_num, r.record FROM kb_fts
+                JOIN kb_rows r ON r.id = kb_fts.rowid
+                WHERE kb_fts MATCH ? ORDER BY bm25(kb_fts) LIMIT ?
+            ''', (match, limit)).fetchall()
+        else:
+            where = ' AND '.join('body LIKE ?' for _ in terms)
+            rows = conn.execute(
+                f'SELECT sheet, row_num, record FROM kb_rows WHERE {where} ORDER BY id LIMIT ?',
+                [f'%{t}%' for t in terms] + [limit]
+            ).fetchall()
+        conn.close()
+    except Exception as e:
+        echo_error(f"Error searching KB: {e}")
+        return
+
+    if not rows:
+        click.echo("No matches.")
+        return
+
+    for sheet, row_num, record in rows:
+        _kb_echo_entry(sheet, row_num, record)
+    click.echo(f"\n{len(rows)} match(es)")
+
+
+@kb.command('list')
+@click.option('--limit', default=None, type=int, help='Number of entries to show (overrides config)')
+def kb_list(limit):
+    """List knowledge base entries."""
+    kb_file = get_kb_file()
+    if not kb_file.exists():
+        echo_error(f"KB file not found: {kb_file}")
+        return
+
+    if limit is None:
+        limit = load_config_toml().get('history_limit', 100)
+
+    try:
+        conn, _ = _kb_open_index()
+        total = conn.execute('SELECT COUNT(*) FROM kb_rows').fetchone()[0]
+        rows = conn.execute('SELECT sheet, row_num, record FROM kb_rows ORDER BY id LIMIT ?', (limit,)).fetchall()
+        conn.close()
+    except Exception as e:
+        echo_error(f"Error reading KB: {e}")
+        return
+
+    if not rows:
+        click.echo("Knowledge base is empty")
+        return
+
+    for sheet, row_num, record in rows:
+        first = next((v for v in json.loads(record).values() if v), '')
+        click.echo(f"{f'{sheet}:{row_num}':<20} {first}")
+    click.echo(f"\nShowing {len(rows)} of {total} entries")
+
+
+@kb.command('add')
+@click.option('-t', '--topic', required=True, help='Entry topic/title')
+@click.option('-c', '--content', required=True, help='Entry content')
+@click.option('--tags', default='', help='Optional comma-separated tags')
+def kb_add(topic, content, tags):
+    """Append an entry to the first sheet of kb.xlsx."""
+    from openpyxl import Workbook, load_workbook
+
+    ensure_config_exists()
+    kb_file = get_kb_file()
+    try:
+        with file_lock(kb_file):
+            if kb_file.exists():
+                wb = load_workbook(kb_file)
+                ws = wb.worksheets[0]
+                header = [str(c.value).strip().lower() if c.value is not None else '' for c in ws[1]]
+            else:
+                wb = Workbook()
+                ws = wb.active
+                ws.title = 'kb'
+                ws.append(KB_COLUMNS)
+                header = list(KB_COLUMNS)
+
+            values = {
+                'topic': topic,
+                'content': content,
+                'tags': tags,
+                'updated_on': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            if not any(h in values for h in header):
+                # Unknown layout: write in default column order
+                header = list(KB_COLUMNS)
+            ws.append([values.get(h, None) for h in header])
+            with atomic_write(kb_file, 'wb') as f:
+                wb.save(f)
+        click.echo(f"✓ Added KB entry '{topic}'")
+    except Exception as e:
+        echo_error(f"Error adding KB entry: {e}")
 
 
 if __name__ == "__main__":
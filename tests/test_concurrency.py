@@ -0,0 +1,126 @@
+"""Stress test for concurrent writers to the TOS config directory.
+
+Starts N writer processes against a fresh TOS_HOME at the same time, so
+they also race on first-run setup. Each process adds its own env keys
+and repeatedly overwrites one shared key with --force. Afterwards every
+key must be present exactly once and the CSV must still parse.
+
+    python -m unittest tests.test_concurrency
+    python tests/test_concurrency.py --writers 16 --adds 50
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+WRITERS = 8
+ADDS_PER_WRITER = 25
+# Lenient floor; adds are serialized by the lock and each one fsyncs
+MIN_ADDS_PER_SECOND = 20.0
+
+
+def _writer(tos_home, worker, adds, start_event, errors):
+    os.environ['TOS_HOME'] = tos_home
+    sys.path.insert(0, str(REPO_ROOT))
+    import main
+
+    start_event.wait()
+    try:
+        for i in range(adds):
+            ok, message = main.add_env_variable(f'w{worker}_k{i}', f'/tmp/w{worker}/{i}')
+            if not ok:
+                errors.put(message)
+            main.add_env_variable('shared', f'/tmp/w{worker}/{i}', force=True)
+    except Exception as e:
+        errors.put(f'worker {worker}: {e!r}')
+
+
+def run_stress(tos_home, writers=WRITERS, adds=ADDS_PER_WRITER):
+    """Run the writers; return (elapsed seconds, errors, rows)."""
+    ctx = multiprocessing.get_context('spawn')
+    start_event = ctx.Event()
+    errors = ctx.Queue()
+    procs = [ctx.Process(target=_writer, args=(tos_home, w, adds, start_event, errors))
+             for w in range(writers)]
+    for p in procs:
+        p.start()
+    # Let the interpreters finish importing before releasing them together
+    time.sleep(1.0)
+    start = time.perf_counter()
+    start_event.set()
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    messages = []
+    while not errors.empty():
+        messages.append(errors.get())
+    messages += [f'writer exited with {p.exitcode}' for p in procs if p.exitcode]
+
+    with open(Path(tos_home) / 'tos_env.csv', 'r', newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    return elapsed, messages, rows
+
+
+class ConcurrentEnvWritesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='tos-stress-')
+        self.tos_home = os.path.join(self.tmp, 'home')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_no_lost_updates(self):
+        elapsed, errors, rows = run_stress(self.tos_home)
+        self.assertEqual(errors, [])
+
+        keys = [row['key'] for row in rows]
+        self.assertEqual(len(keys), len(set(keys)), 'duplicate keys in tos_env.csv')
+        expected = {f'w{w}_k{i}' for w in range(WRITERS) for i in range(ADDS_PER_WRITER)}
+        self.assertEqual(expected - set(keys), set(), 'lost updates')
+        self.assertEqual(keys.count('shared'), 1)
+
+        # No temp files from atomic writes left behind
+        leftovers = [p.name for p in Path(self.tos_home).glob('.tos_env.csv.*.tmp')]
+        self.assertEqual(leftovers, [])
+
+        writes = 2 * WRITERS * ADDS_PER_WRITER
+        self.assertGreaterEqual(writes / elapsed, MIN_ADDS_PER_SECOND,
+                                f'{writes} writes took {elapsed:.2f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=WRITERS)
+    parser.add_argument('--adds', type=int, default=ADDS_PER_WRITER)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='tos-stress-')
+    try:
+        elapsed, errors, rows = run_stress(os.path.join(tmp, 'home'), args.writers, args.adds)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    expected = args.writers * args.adds
+    keys = {row['key'] for row in rows}
+    found = sum(1 for w in range(args.writers) for i in range(args.adds) if f'w{w}_k{i}' in keys)
+    writes = 2 * expected
+    print(f'{args.writers} writers, {writes} writes in {elapsed:.2f}s '
+          f'({writes / elapsed:.0f} writes/s)')
+    print(f'{found}/{expected} keys present, {len(errors)} error(s)')
+    for message in errors:
+        print(f'  {message}')
+    return 0 if found == expected and not errors else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())